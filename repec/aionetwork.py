@@ -0,0 +1,163 @@
+# Copyright (c) 2021, Andrey Dubovik <andrei@dubovik.eu>
+
+"""Asynchronous download engine.
+
+HTTP(S) requests are issued from a single asyncio event loop, so that
+thousands of them can be in flight at once without a thread per request.
+Processing of the downloaded content, and any non-HTTP downloads, still
+run in a thread pool. Requires aiohttp.
+"""
+
+# Load global packages
+import asyncio
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+from requests.utils import get_encoding_from_headers
+
+# Load local packages
+import settings
+import cache
+import health
+from network import NotModified, conditional
+
+
+class Failure:
+    """An exception raised in the event loop."""
+
+    def __init__(self, err):
+        self.err = err
+
+
+def interleave(lst, key):
+    """Reorder a list so that consecutive elements have different keys."""
+    queues = {}
+    for el in lst:
+        queues.setdefault(key(el), []).append(el)
+    queues = sorted(queues.values(), key=len, reverse=True)
+    rslt = []
+    for i in range(len(queues[0]) if queues else 0):
+        rslt.extend(q[i] for q in queues if i < len(q))
+    return rslt
+
+
+async def fetch(session, url, validators=None):
+    """Fetch an URL, return the same as network.fetch_new does."""
+    if settings.offline:
+        return cache.load(url)
+    import aiohttp  # optional dependency
+    if validators is not None:
+        fresh = await asyncio.get_running_loop().run_in_executor(
+            None, cache.fresh, url, validators,
+        )
+        if not fresh:
+            validators = None  # download again, to fill the cache
+    headers = conditional(validators)
+    with health.track(url) as (connect, read):
+        timeout = aiohttp.ClientTimeout(
+            total=settings.timeout, sock_connect=connect, sock_read=read,
+        )
+        async with session.get(
+            url, headers=headers, proxy=settings.proxy, timeout=timeout,
+        ) as response:
+            if response.status == 304 and headers:
+                raise NotModified('Not modified')
+            if response.status != 200:
+                raise RuntimeError('HTTP Error {}'.format(response.status))
+            content = await response.read()
+            encoding = get_encoding_from_headers(response.headers)
+            etag = response.headers.get('ETag')
+            last_modified = response.headers.get('Last-Modified')
+    await asyncio.get_running_loop().run_in_executor(
+        None, cache.store, url, content, encoding, etag, last_modified,
+    )
+    return content, encoding, (etag, last_modified, len(content))
+
+
+async def run(func, urls, validators, put):
+    """Download and process all URLs, pass results on to put()."""
+    import aiohttp  # optional dependency
+
+    loop = asyncio.get_running_loop()
+    slots = asyncio.Semaphore(settings.no_connections)
+    hosts = {}  # host slots, so that host health is checked when a slot frees
+    failed = []
+    connector = aiohttp.TCPConnector(
+        limit=settings.no_connections,
+        limit_per_host=settings.no_threads_host,
+    )
+    timeout = aiohttp.ClientTimeout(total=settings.timeout)
+    headers = {'User-Agent': settings.user_agent}
+
+    async def worker(session, url):
+        try:
+            response = None  # func downloads non-HTTP URLs by itself
+            u = urlparse(url)
+            if u[0] in ['http', 'https']:
+                limit = settings.no_threads_host
+                host = hosts.setdefault(u[:2], asyncio.Semaphore(limit))
+                try:
+                    async with host:
+                        response = await fetch(
+                            session, url, validators.get(url),
+                        )
+                except asyncio.TimeoutError:
+                    response = RuntimeError('Timeout')
+                except Exception as err:
+                    response = err
+            put(await loop.run_in_executor(executor, func, url, response))
+        except BaseException as err:
+            failed.append(err)
+        finally:
+            slots.release()
+
+    executor = ThreadPoolExecutor(max_workers=settings.no_threads_www)
+    try:
+        async with aiohttp.ClientSession(
+            connector=connector, timeout=timeout, headers=headers,
+        ) as session:
+            tasks = set()
+            for url in urls:
+                await slots.acquire()
+                if failed:
+                    break
+                task = asyncio.create_task(worker(session, url))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            await asyncio.gather(*tasks)
+    finally:
+        executor.shutdown()
+    if failed:
+        raise failed[0]
+
+
+def stream(func, urls, key=None, validators={}):
+    """Apply func(url, response) to URLs in parallel, yield the results.
+
+    For HTTP(S) URLs, the response is either a (content, encoding,
+    validators) tuple, as returned by network.fetch_new, or an exception.
+    For other URLs, the response is None. If a key function is given, URLs
+    with different keys are interleaved. Validators from earlier downloads,
+    if given for an URL, make the request conditional.
+    """
+    if key is not None:
+        urls = interleave(urls, key)
+    results = queue.Queue()
+    done = object()
+
+    def target():
+        try:
+            asyncio.run(run(func, urls, validators, results.put))
+        except BaseException as err:
+            results.put(Failure(err))
+        results.put(done)
+
+    threading.Thread(target=target, daemon=True).start()
+    while True:
+        r = results.get()
+        if r is done:
+            break
+        elif isinstance(r, Failure):
+            raise r.err
+        yield r
@@ -0,0 +1,209 @@
+# Copyright (c) 2021, Andrey Dubovik <andrei@dubovik.eu>
+
+"""On-disk cache of downloaded content.
+
+Downloaded files are stored under their SHA-256 digests, so identical
+content downloaded from several URLs is stored only once. An SQLite index
+maps URLs to digests, together with the fetch metadata. When the cache
+grows beyond its size limit, least recently used URLs are evicted. URLs
+that are checked for changes and found unchanged count as used.
+"""
+
+# Load global packages
+import os
+import sqlite3
+import threading
+import time
+from hashlib import sha256
+
+# Load local packages
+import settings
+
+# Define constants
+SQL = """
+    CREATE TABLE IF NOT EXISTS objects (
+        digest text PRIMARY KEY,
+        size integer
+    );
+    CREATE TABLE IF NOT EXISTS urls (
+        url text PRIMARY KEY,
+        digest text REFERENCES objects,
+        encoding text,
+        etag text,
+        last_modified text,
+        fetched_at real,
+        accessed_at real
+    );
+    CREATE INDEX IF NOT EXISTS urls_digest ON urls (digest);
+    CREATE INDEX IF NOT EXISTS urls_accessed_at ON urls (accessed_at);
+"""
+
+# The cache in use, opened on first access
+CACHE = None
+CACHE_LOCK = threading.Lock()
+
+
+class Cache:
+    """A size-bounded, content-addressed store of downloaded files."""
+
+    def __init__(self, root, limit):
+        os.makedirs(root, exist_ok=True)
+        self.root = root
+        self.limit = limit
+        self.lock = threading.Lock()
+        path = os.path.join(root, 'index.db')
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode = WAL')
+        self.conn.executescript(SQL)
+        sql = 'SELECT coalesce(sum(size), 0) FROM objects'
+        self.size, = self.conn.execute(sql).fetchone()
+
+    def path(self, digest):
+        """Get the file name of a cached object."""
+        return os.path.join(self.root, digest[:2], digest[2:])
+
+    def get(self, url):
+        """Get content, encoding and validators, or None if not cached."""
+        with self.lock:
+            sql = (
+                'SELECT digest, encoding, etag, last_modified FROM urls'
+                ' WHERE url = ?'
+            )
+            row = self.conn.execute(sql, (url, )).fetchone()
+            if row is None:
+                return None
+            digest, encoding, etag, last_modified = row
+            with self.conn:
+                sql = 'UPDATE urls SET accessed_at = ? WHERE url = ?'
+                self.conn.execute(sql, (time.time(), url))
+        try:
+            with open(self.path(digest), 'rb') as f:
+                content = f.read()
+        except FileNotFoundError:
+            return None
+        return content, encoding, (etag, last_modified, len(content))
+
+    def put(self, url, content, encoding=None, etag=None, last_modified=None):
+        """Save downloaded content."""
+        digest = sha256(content).hexdigest()
+        path = self.path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f'{path}.{threading.get_ident()}'
+            with open(tmp, 'wb') as f:
+                f.write(content)
+            os.replace(tmp, path)
+        now = time.time()
+        with self.lock, self.conn:
+            sql = 'INSERT OR IGNORE INTO objects (digest, size) VALUES (?, ?)'
+            if self.conn.execute(sql, (digest, len(content))).rowcount:
+                self.size += len(content)
+            sql = 'SELECT digest FROM urls WHERE url = ?'
+            old = self.conn.execute(sql, (url, )).fetchone()
+            sql = (
+                'REPLACE INTO urls (url, digest, encoding, etag,'
+                ' last_modified, fetched_at, accessed_at)'
+                ' VALUES (?, ?, ?, ?, ?, ?, ?)'
+            )
+            row = (url, digest, encoding, etag, last_modified, now, now)
+            self.conn.execute(sql, row)
+            if old is not None and old[0] != digest:
+                self.release(old[0])  # the previous version of the URL
+            if self.size > self.limit:
+                self.evict()
+
+    def touch(self, url, validators):
+        """Mark an URL as used, return whether its cached copy is current.
+
+        The copy is current if it was stored with the given validators.
+        """
+        etag, last_modified, size = validators
+        with self.lock:
+            sql = (
+                'SELECT digest FROM urls JOIN objects USING (digest)'
+                ' WHERE url = ? AND etag IS ? AND last_modified IS ?'
+                ' AND size IS ?'
+            )
+            row = self.conn.execute(
+                sql, (url, etag, last_modified, size),
+            ).fetchone()
+            if row is None or not os.path.exists(self.path(row[0])):
+                return False
+            with self.conn:
+                sql = 'UPDATE urls SET accessed_at = ? WHERE url = ?'
+                self.conn.execute(sql, (time.time(), url))
+        return True
+
+    def release(self, digest):
+        """Delete an object unless it is still referenced by an URL."""
+        sql = 'SELECT 1 FROM urls WHERE digest = ?'
+        if self.conn.execute(sql, (digest, )).fetchone():
+            return
+        sql = 'SELECT size FROM objects WHERE digest = ?'
+        row = self.conn.execute(sql, (digest, )).fetchone()
+        if row is None:
+            return
+        sql = 'DELETE FROM objects WHERE digest = ?'
+        self.conn.execute(sql, (digest, ))
+        try:
+            os.remove(self.path(digest))
+        except FileNotFoundError:
+            pass
+        self.size -= row[0]
+
+    def evict(self):
+        """Drop least recently used URLs until the cache is 10% under limit."""
+        # Objects left behind by URLs that were stored again
+        sql = (
+            'SELECT digest FROM objects WHERE digest NOT IN'
+            ' (SELECT digest FROM urls WHERE digest IS NOT NULL)'
+        )
+        for digest, in self.conn.execute(sql).fetchall():
+            self.release(digest)
+        while self.size > 0.9*self.limit:
+            sql = 'SELECT url, digest FROM urls ORDER BY accessed_at LIMIT 100'
+            rows = self.conn.execute(sql).fetchall()
+            if not rows:
+                break
+            sql = 'DELETE FROM urls WHERE url = ?'
+            self.conn.executemany(sql, [(u, ) for u, _ in rows])
+            for digest in set(d for _, d in rows):
+                self.release(digest)
+
+
+def instance():
+    """Get the cache configured in settings, or None."""
+    global CACHE
+    if settings.cache is None:
+        return None
+    with CACHE_LOCK:
+        if CACHE is None:
+            CACHE = Cache(settings.cache, settings.cache_limit*2**30)
+        return CACHE
+
+
+def store(url, content, encoding=None, etag=None, last_modified=None):
+    """Save downloaded content if caching is enabled."""
+    c = instance()
+    if c is not None:
+        c.put(url, content, encoding, etag, last_modified)
+
+
+def fresh(url, validators):
+    """Check whether a conditional request can be made for an URL.
+
+    With caching enabled, a document that has not changed should still be
+    in the cache, so the request is only conditional if the cached copy is
+    current. The cached copy is then marked as used.
+    """
+    c = instance()
+    return c is None or c.touch(url, validators)
+
+
+def load(url):
+    """Get cached content, encoding and validators (offline mode)."""
+    c = instance()
+    entry = c.get(url) if c is not None else None
+    if entry is None:
+        raise RuntimeError('Not in cache')
+    return entry
@@ -0,0 +1,140 @@
+# Copyright (c) 2021, Andrey Dubovik <andrei@dubovik.eu>
+
+"""Compression of the ReDIF records stored in papers.redif.
+
+Records were originally stored as plain zlib streams, which always start
+with byte 0x78 (deflate with the default window). Other codecs prefix
+their output with a tag byte that no zlib stream starts with, so rows
+written with different codecs can be mixed in one database. Zstandard
+frames can reference a dictionary trained on a sample of records, which
+helps a lot with records as small as these. The codec in use and the
+dictionaries are kept in table meta. Requires zstandard for zstd.
+"""
+
+# Load global packages
+import threading
+import zlib
+
+# Define constants
+ZSTD = 0x01  # tag byte of zstd frames
+LEVELS = {'zlib': 6, 'zstd': 3}  # default compression levels
+DICT_SIZE = 112640  # bytes, the default of zstd --train
+NO_SAMPLES = 10000  # records sampled to train a dictionary
+
+
+class Codec:
+    """Encode and decode ReDIF blobs.
+
+    Blobs are encoded with the given codec and level and, for zstd, with
+    the dictionary dict_id, if given. Blobs written earlier with other
+    codecs or dictionaries are decoded as long as all the dictionaries
+    are given as a mapping from dictionary ids to dictionary data.
+    Compressors are not shared between threads.
+    """
+
+    def __init__(self, name='zlib', level=None, dictionaries={}, dict_id=None):
+        if name not in LEVELS:
+            raise RuntimeError(f'Unknown codec: {name}')
+        if dict_id is not None and dict_id not in dictionaries:
+            raise RuntimeError(f'Unknown dictionary: {dict_id}')
+        self.name = name
+        self.level = LEVELS[name] if level is None else level
+        self.dictionaries = dict(dictionaries)
+        self.dict_id = dict_id if name == 'zstd' else None
+        self.local = threading.local()
+
+    def __reduce__(self):
+        # Compressors cannot be pickled, new ones are made on first use
+        args = (self.name, self.level, self.dictionaries, self.dict_id)
+        return Codec, args
+
+    def compressor(self):
+        """Get the zstd compressor of the current thread."""
+        if not hasattr(self.local, 'compressor'):
+            import zstandard  # optional dependency
+            data = None
+            if self.dict_id is not None:
+                data = self.dictionary(self.dict_id)
+            self.local.compressor = zstandard.ZstdCompressor(
+                level=self.level, dict_data=data,
+            )
+        return self.local.compressor
+
+    def decompressor(self, dict_id):
+        """Get the zstd decompressor of the current thread for a dictionary."""
+        if not hasattr(self.local, 'decompressors'):
+            self.local.decompressors = {}
+        if dict_id not in self.local.decompressors:
+            import zstandard  # optional dependency
+            data = self.dictionary(dict_id) if dict_id else None
+            self.local.decompressors[dict_id] = zstandard.ZstdDecompressor(
+                dict_data=data,
+            )
+        return self.local.decompressors[dict_id]
+
+    def dictionary(self, dict_id):
+        """Get a zstd dictionary by its id."""
+        import zstandard  # optional dependency
+        if dict_id not in self.dictionaries:
+            raise RuntimeError(f'Unknown dictionary: {dict_id}')
+        return zstandard.ZstdCompressionDict(self.dictionaries[dict_id])
+
+    def encode(self, blob):
+        """Compress a record."""
+        if self.name == 'zstd':
+            return bytes([ZSTD]) + self.compressor().compress(blob)
+        return zlib.compress(blob, level=self.level)
+
+    def decode(self, data):
+        """Decompress a record, whichever codec it was written with."""
+        if data[0] == ZSTD:
+            import zstandard  # optional dependency
+            frame = data[1:]
+            dict_id = zstandard.get_frame_parameters(frame).dict_id
+            return self.decompressor(dict_id).decompress(frame)
+        return zlib.decompress(data)
+
+
+def train(samples, size=DICT_SIZE):
+    """Train a zstd dictionary on sample records, return its id and data."""
+    import zstandard  # optional dependency
+    d = zstandard.train_dictionary(size, samples)
+    return d.dict_id(), d.as_bytes()
+
+
+def load(conn):
+    """Get the codec configured for a database."""
+    sql = (
+        'SELECT parameter, value FROM meta'
+        " WHERE parameter LIKE 'codec%' OR parameter LIKE 'dictionary:%'"
+    )
+    meta = dict(conn.execute(sql).fetchall())
+    dictionaries = {
+        int(p.split(':')[1]): bytes(v)
+        for p, v in meta.items() if p.startswith('dictionary:')
+    }
+    level = meta.get('codec_level')
+    dict_id = meta.get('codec_dictionary')
+    return Codec(
+        name=meta.get('codec', 'zlib'),
+        level=None if level is None else int(level),
+        dictionaries=dictionaries,
+        dict_id=None if dict_id is None else int(dict_id),
+    )
+
+
+def save(conn, codec):
+    """Configure the codec of a database, keep only dictionaries in use."""
+    sql = "DELETE FROM meta WHERE parameter LIKE 'dictionary:%'"
+    conn.execute(sql)
+    sql = 'REPLACE INTO meta (parameter, value) VALUES (?, ?)'
+    conn.executemany(sql, [
+        ('codec', codec.name),
+        ('codec_level', codec.level),
+        *((f'dictionary:{i}', d) for i, d in codec.dictionaries.items()),
+    ])
+    sql = "DELETE FROM meta WHERE parameter = 'codec_dictionary'"
+    conn.execute(sql)
+    if codec.dict_id is not None:
+        sql = "INSERT INTO meta VALUES ('codec_dictionary', ?)"
+        conn.execute(sql, (codec.dict_id, ))
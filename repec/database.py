@@ -6,21 +6,27 @@
 # Load global packages
 import sqlite3
 import os
+import re
+import time
+from hashlib import sha1
 from lxml import etree
 from html import unescape
 
 # Load local packages
 import settings
+import codec
 from network import fetch
 
 # Define constants
-DBVERSION = '8'
+DBVERSION = '12'
+SQLITE_VERSION = (3, 33, 0)  # for UPDATE FROM
 
 SQL = f"""
     CREATE TABLE repec (
         file text PRIMARY KEY,
         type text,
         ftpdate text,
+        digest text,
         status integer DEFAULT 1,
         error text,
         replaced_at text DEFAULT CURRENT_TIMESTAMP
@@ -44,6 +50,10 @@ SQL = f"""
     CREATE TABLE listings (
         url text PRIMARY KEY,
         remote text,
+        etag text,
+        last_modified text,
+        size integer,
+        digest text,
         status integer DEFAULT 1,
         error text,
         replaced_at text DEFAULT CURRENT_TIMESTAMP
@@ -62,6 +72,7 @@ SQL = f"""
         issue integer,
         pages text,
         redif blob,
+        digest text,
         replaced_at text DEFAULT CURRENT_TIMESTAMP
     );
     CREATE TABLE authors (
@@ -80,7 +91,6 @@ SQL = f"""
         code text REFERENCES jel,
         PRIMARY KEY (pid, code)
     );
-    CREATE INDEX papers_jel_code ON papers_jel (code);
     CREATE TABLE meta (
         parameter text PRIMARY KEY,
         value text
@@ -89,6 +99,129 @@ SQL = f"""
         ('version', {DBVERSION});
 """
 
+# Secondary indexes for analytical queries. They are not needed for
+# updates, and are only created after the papers have been loaded, see
+# create_indexes(). Changes to this set require a new database version.
+# The handle index serves case-insensitive LIKE prefix queries. Approximate
+# statistics are enough for the query planner.
+INDEXES = """
+    CREATE INDEX IF NOT EXISTS papers_year ON papers (year, template);
+    CREATE INDEX IF NOT EXISTS papers_template ON papers (template, year);
+    CREATE INDEX IF NOT EXISTS papers_journal ON papers (journal, year);
+    CREATE INDEX IF NOT EXISTS papers_language ON papers (language, year);
+    CREATE INDEX IF NOT EXISTS papers_handle
+        ON papers (handle COLLATE NOCASE, template);
+    CREATE INDEX IF NOT EXISTS papers_jel_code ON papers_jel (code, pid);
+    PRAGMA analysis_limit = 1000;
+    ANALYZE;
+"""
+
+# Queries to time the indexes with: description -> (SQL, arguments)
+BENCHMARK = {
+    'Papers by year and JEL code': (
+        'SELECT count(*) FROM papers JOIN papers_jel USING (pid)'
+        ' WHERE year = ? AND code = ?',
+        (2010, 'D43'),
+    ),
+    'Articles per year': (
+        'SELECT year, count(*) FROM papers WHERE template = ?'
+        ' GROUP BY year',
+        ('article', ),
+    ),
+    'Papers per year in a journal': (
+        'SELECT year, count(*) FROM papers WHERE journal = ? GROUP BY year',
+        ('American Economic Review', ),
+    ),
+    'Papers per year in a language': (
+        'SELECT year, count(*) FROM papers WHERE language = ? GROUP BY year',
+        ('de', ),
+    ),
+    'Papers per template in an archive': (
+        'SELECT template, count(*) FROM papers WHERE handle LIKE ?'
+        ' GROUP BY template',
+        ('RePEc:cpb:%', ),
+    ),
+    'Papers per year mentioning a word': (
+        'SELECT year, count(*) FROM papers_fts'
+        ' JOIN papers ON pid = papers_fts.rowid'
+        ' WHERE papers_fts MATCH ? GROUP BY year',
+        ('replicate', ),
+    ),
+}
+
+# Optional full-text index over titles, abstracts and author names, kept
+# up to date by triggers. Papers are upserted in place, so that their rows
+# are updated rather than deleted and inserted again.
+FTS_SQL = """
+    CREATE VIRTUAL TABLE papers_fts USING fts5 (
+        title, abstract, authors,
+        tokenize = 'unicode61 remove_diacritics 2'
+    );
+    CREATE TRIGGER papers_fts_insert AFTER INSERT ON papers BEGIN
+        INSERT INTO papers_fts (rowid, title, abstract)
+            VALUES (new.pid, new.title, new.abstract);
+    END;
+    CREATE TRIGGER papers_fts_update AFTER UPDATE OF title, abstract
+        ON papers BEGIN
+        UPDATE papers_fts SET title = new.title, abstract = new.abstract
+            WHERE rowid = new.pid;
+    END;
+    CREATE TRIGGER papers_fts_delete AFTER DELETE ON papers BEGIN
+        DELETE FROM papers_fts WHERE rowid = old.pid;
+    END;
+    CREATE TRIGGER authors_fts_insert AFTER INSERT ON authors BEGIN
+        UPDATE papers_fts SET authors = (
+            SELECT group_concat(name, ' ') FROM authors WHERE pid = new.pid
+        ) WHERE rowid = new.pid;
+    END;
+    CREATE TRIGGER authors_fts_delete AFTER DELETE ON authors BEGIN
+        UPDATE papers_fts SET authors = (
+            SELECT group_concat(name, ' ') FROM authors WHERE pid = old.pid
+        ) WHERE rowid = old.pid;
+    END;
+"""
+
+FTS_DROP = """
+    DROP TRIGGER IF EXISTS papers_fts_insert;
+    DROP TRIGGER IF EXISTS papers_fts_update;
+    DROP TRIGGER IF EXISTS papers_fts_delete;
+    DROP TRIGGER IF EXISTS authors_fts_insert;
+    DROP TRIGGER IF EXISTS authors_fts_delete;
+    DROP TABLE IF EXISTS papers_fts;
+"""
+
+FTS_FILL = """
+    INSERT INTO papers_fts (rowid, title, abstract, authors)
+        SELECT pid, title, abstract, (
+            SELECT group_concat(name, ' ') FROM authors a WHERE a.pid = p.pid
+        ) FROM papers p;
+    INSERT INTO papers_fts (papers_fts) VALUES ('optimize');
+"""
+
+# Migrations from older database versions: version -> (new version, SQL)
+MIGRATIONS = {
+    '8': ('9', """
+        ALTER TABLE repec ADD COLUMN digest text;
+        ALTER TABLE listings ADD COLUMN etag text;
+        ALTER TABLE listings ADD COLUMN last_modified text;
+        ALTER TABLE listings ADD COLUMN size integer;
+        ALTER TABLE listings ADD COLUMN digest text;
+    """),
+    '9': ('10', """
+        ALTER TABLE papers ADD COLUMN digest text;
+    """),
+    '10': ('11', """
+        DROP INDEX IF EXISTS papers_jel_code;
+        DROP INDEX IF EXISTS papers_tejoha;
+    """ + INDEXES),
+    # Papers are now updated in place, and their authors and JEL codes are
+    # only rewritten if the digests differ, so fill in the digests missing
+    # from the papers written before version 10
+    '11': ('12', """
+        UPDATE papers SET digest = redif_digest(redif) WHERE digest IS NULL;
+    """),
+}
+
 
 def jcode(item):
     """Get JEL code."""
@@ -114,7 +247,7 @@ def import_level(c, element):
 
 def populate_jel(conn):
     """Download and save official JEL classification."""
-    content, _ = fetch(settings.jel)
+    content, _, _ = fetch(settings.jel)
     xml = etree.fromstring(content)
     with conn:
         c = conn.cursor()
@@ -128,13 +261,140 @@ def prepare(path):
         raise RuntimeError('Database already exists')
     conn = sqlite3.connect(path)
     conn.executescript(SQL)
+    if settings.fts:
+        conn.executescript(FTS_SQL)
+    with conn:
+        codec.save(conn, codec.Codec(settings.codec, settings.codec_level))
     populate_jel(conn)
 
 
-def check_version():
-    """Verify database version."""
+def get_version(conn):
+    """Get database version."""
     sql = "SELECT value FROM meta WHERE parameter = 'version'"
-    conn = sqlite3.connect(settings.database)
     version, = conn.execute(sql).fetchone()
+    return str(version)
+
+
+def check_version():
+    """Verify database version, and SQLite version."""
+    if sqlite3.sqlite_version_info < SQLITE_VERSION:
+        required = '.'.join(map(str, SQLITE_VERSION))
+        raise RuntimeError(
+            f'SQLite {required} or newer is required, found'
+            f' {sqlite3.sqlite_version}'
+        )
+    conn = sqlite3.connect(settings.database)
+    version = get_version(conn)
+    conn.close()
     if version != DBVERSION:
+        if version in MIGRATIONS:
+            raise RuntimeError(
+                'Outdated database version, run "main.py migrate" first'
+            )
         raise RuntimeError('Incompatible database version')
+
+
+def migrate(path):
+    """Bring an existing database up to the current version."""
+    conn = sqlite3.connect(path)
+    coder = codec.load(conn)
+    conn.create_function(
+        'redif_digest', 1, lambda redif: sha1(coder.decode(redif)).hexdigest(),
+        deterministic=True,
+    )
+    version = get_version(conn)
+    while version != DBVERSION:
+        if version not in MIGRATIONS:
+            raise RuntimeError('Incompatible database version')
+        version, sql = MIGRATIONS[version]
+        print(f'Migrating to version {version}...')
+        meta = "UPDATE meta SET value = '{}' WHERE parameter = 'version';"
+        conn.executescript('BEGIN;' + sql + meta.format(version) + 'COMMIT;')
+    conn.close()
+
+
+def rebuild_fts(path, drop=False):
+    """Create or rebuild the full-text index, or drop it."""
+    conn = sqlite3.connect(path)
+    try:
+        script = FTS_DROP if drop else FTS_DROP + FTS_SQL + FTS_FILL
+        conn.executescript('BEGIN;' + script + 'COMMIT;')
+    finally:
+        conn.close()
+
+
+def create_indexes(path):
+    """Create the secondary indexes if missing."""
+    conn = sqlite3.connect(path)
+    try:
+        conn.executescript(INDEXES)
+    finally:
+        conn.close()
+
+
+def start_bulk_load(path):
+    """Prepare a database without papers for bulk loading.
+
+    Drop the secondary indexes and the full-text index, which are cheaper
+    to build once the papers are loaded. Return whether the database had a
+    full-text index. While bulk loading, connections run without a journal
+    and without foreign key checks, see misc.connect(). The papers are
+    kept unique by handle, and authors are kept indexed by pid, which is
+    needed to replace the authors of papers found in several documents.
+    """
+    conn = sqlite3.connect(path)
+    try:
+        no_papers, = conn.execute('SELECT count(*) FROM papers').fetchone()
+        if no_papers > 0:
+            raise RuntimeError('Bulk loading requires a new database')
+        sql = "SELECT 1 FROM sqlite_master WHERE name = 'papers_fts'"
+        fts = conn.execute(sql).fetchone() is not None
+        indexes = re.findall(r'CREATE INDEX IF NOT EXISTS (\w+)', INDEXES)
+        script = ''.join(f'DROP INDEX IF EXISTS {i};' for i in indexes)
+        conn.executescript('BEGIN;' + script + FTS_DROP + 'COMMIT;')
+        # Connections without a journal cannot share the database with
+        # connections in WAL mode
+        conn.execute('PRAGMA journal_mode = DELETE')
+    finally:
+        conn.close()
+    return fts
+
+
+def finish_bulk_load(path, fts=False):
+    """Verify foreign keys after bulk loading, rebuild the full-text index."""
+    conn = sqlite3.connect(path)
+    try:
+        sql = 'PRAGMA foreign_key_check'
+        violations = {}
+        for table, *_ in conn.execute(sql):
+            violations[table] = violations.get(table, 0) + 1
+        for table, count in violations.items():
+            print(f'Foreign key check: {count} invalid rows in table {table}')
+        conn.execute('PRAGMA journal_mode = WAL')
+    finally:
+        conn.close()
+    if fts:
+        print('Building full-text index...')
+        rebuild_fts(path)
+
+
+def benchmark(path, repeat=3):
+    """Time the typical analytical queries, show their query plans."""
+    conn = sqlite3.connect(path)
+    try:
+        for name, (sql, args) in BENCHMARK.items():
+            try:
+                plan = conn.execute('EXPLAIN QUERY PLAN ' + sql, args)
+            except sqlite3.OperationalError as err:
+                print(f'{name}: {err}')
+                continue
+            times = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                conn.execute(sql, args).fetchall()
+                times.append(time.perf_counter() - started)
+            print(f'{name}: {min(times)*1000:,.1f} ms')
+            for row in plan.fetchall():
+                print(f'    {row[-1]}')
+    finally:
+        conn.close()
@@ -0,0 +1,133 @@
+# Copyright (c) 2021, Andrey Dubovik <andrei@dubovik.eu>
+
+"""Health of remote hosts.
+
+Requests to each host are tracked. Once a host has failed a number of
+times in a row, e.g. because it does not accept connections or times out,
+further requests to it are skipped (a circuit breaker), and only after a
+cool-down period is a single request let through to probe the host again.
+Read timeouts adapt to the response times observed for each host, while
+connect timeouts are fixed, as establishing a connection takes about the
+same time regardless of the request.
+"""
+
+# Load global packages
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+# Load local packages
+import settings
+
+# Define constants
+NO_SAMPLES = 5  # response times needed before adapting the read timeout
+MARGIN = 4  # read timeout as a multiple of the slowest response time
+
+# Tracked hosts, by host name
+HOSTS = {}
+HOSTS_LOCK = threading.Lock()
+
+
+class HostDown(RuntimeError):
+    """A request was skipped, as its host has failed too often."""
+
+
+class Host:
+    """Failures and response times of a single host."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.failures = 0  # in a row
+        self.opened = None  # when the host was last skipped or probed
+        self.skipped = 0
+        self.times = deque(maxlen=100)
+
+    def check(self):
+        """Raise HostDown if requests to this host should be skipped."""
+        with self.lock:
+            if not 0 < settings.max_failures <= self.failures:
+                return
+            now = time.monotonic()
+            if now - self.opened >= settings.cooldown:
+                self.opened = now  # let a single request through
+                return
+            self.skipped += 1
+        raise HostDown(f'Skipped after {self.failures} failures in a row')
+
+    def timeouts(self):
+        """Get connect and read timeouts for the next request."""
+        with self.lock:
+            read = settings.timeout
+            if len(self.times) >= NO_SAMPLES:
+                read = MARGIN*max(self.times)
+                read = min(max(read, settings.min_timeout), settings.timeout)
+        return settings.connect_timeout, read
+
+    def succeeded(self, elapsed=None):
+        """Record a response, and the time it took."""
+        with self.lock:
+            self.failures = 0
+            if elapsed is not None:
+                self.times.append(elapsed)
+
+    def failed(self):
+        """Record a failure to connect or to get a response in time."""
+        with self.lock:
+            self.failures += 1
+            if self.failures == settings.max_failures:
+                self.opened = time.monotonic()
+
+
+def host(url):
+    """Get the tracked state of the host of an URL."""
+    name = urlparse(url).hostname
+    with HOSTS_LOCK:
+        h = HOSTS.get(name)
+        if h is None:
+            h = HOSTS[name] = Host()
+        return h
+
+
+def timeouts(url):
+    """Get connect and read timeouts for a request to an URL."""
+    return host(url).timeouts()
+
+
+@contextmanager
+def track(url):
+    """Track a request to an URL, yield its connect and read timeouts.
+
+    Raise HostDown instead if the host has failed too often. Network
+    errors, including timeouts, count as failures. Any other outcome,
+    e.g. an HTTP error, means that the host is up.
+    """
+    h = host(url)
+    h.check()
+    started = time.monotonic()
+    try:
+        yield h.timeouts()
+    except (OSError, EOFError):
+        h.failed()
+        raise
+    except Exception:
+        h.succeeded()
+        raise
+    h.succeeded(time.monotonic() - started)
+
+
+def report():
+    """Print the hosts that requests were skipped for."""
+    with HOSTS_LOCK:
+        down = {n: h for n, h in HOSTS.items() if h.skipped > 0}
+    if down:
+        skipped = sum(h.skipped for h in down.values())
+        print(
+            f'Skipped {skipped} requests to {len(down)} unresponsive hosts,'
+            ' to be retried in the next update'
+        )
+    for name, h in sorted(down.items()):
+        h.skipped = 0
+        if settings.verbosity >= 2:
+            print(f'    {name}: {h.failures} failures in a row')
@@ -5,6 +5,7 @@
 
 # Load standard packages
 import argparse
+import os
 
 # Load local packages
 import settings
@@ -18,16 +19,77 @@ def init(args):
     """Initialize the database."""
     settings.database = args.database
     settings.proxy = args.proxy
+    settings.codec = args.codec
+    settings.codec_level = args.level
+    settings.fts = args.fts
     database.prepare(settings.database)
 
 
+def migrate(args):
+    """Migrate the database to the current version."""
+    settings.database = args.database
+    database.migrate(settings.database)
+
+
+def benchmark(args):
+    """Time typical analytical queries."""
+    settings.database = args.database
+    database.check_version()  # Abort on incompatible versions
+    database.benchmark(settings.database, args.repeat)
+
+
+def fts(args):
+    """Create, rebuild or drop the full-text index."""
+    settings.database = args.database
+    database.check_version()  # Abort on incompatible versions
+    database.rebuild_fts(settings.database, args.drop)
+
+
+def recompress(args):
+    """Encode stored ReDIF records again."""
+    settings.database = args.database
+    settings.batch_size = args.batchsize
+    settings.no_processes = args.cpu_workers
+    settings.verbosity = max(settings.verbosity - args.quiet, 0)
+    database.check_version()  # Abort on incompatible versions
+    papers.recompress(args.codec, args.level, args.train)
+
+
+def reprocess(args):
+    """Destructure stored papers again."""
+    settings.database = args.database
+    settings.batch_size = args.batchsize
+    settings.no_processes = args.cpu_workers
+    settings.trust_language = args.trust_language
+    settings.language_cache = args.language_cache
+    settings.verbosity = max(settings.verbosity - args.quiet, 0)
+    database.check_version()  # Abort on incompatible versions
+    papers.reprocess(args.handle, args.template)
+
+
 def update(args):
     """Run full database update."""
     settings.database = args.database
     settings.timeout = args.timeout
+    settings.connect_timeout = args.connect_timeout
+    settings.max_failures = args.max_failures
     settings.batch_size = args.batchsize
+    settings.commit_interval = args.commit_interval
     settings.no_threads_repec = args.threads_repec
     settings.no_threads_www = args.threads_www
+    settings.no_threads_host = args.threads_host
+    settings.no_processes = args.cpu_workers
+    settings.trust_language = args.trust_language
+    settings.language_cache = args.language_cache
+    settings.engine = args.engine
+    settings.force = args.force or args.offline
+    settings.bulk_load = args.bulk_load
+    settings.cache = args.cache
+    settings.cache_limit = args.cache_limit
+    settings.offline = args.offline
+    if settings.offline and settings.cache is None:
+        raise RuntimeError('Offline mode requires --cache')
+    settings.no_connections = args.connections
     settings.proxy = args.proxy
     settings.verbosity = max(settings.verbosity - args.quiet, 0)
 
@@ -35,6 +97,8 @@ def update(args):
         args.repec = args.listings = args.papers = True
 
     database.check_version()  # Abort on incompatible versions
+    if settings.bulk_load:
+        fts = database.start_bulk_load(settings.database)
 
     if args.repec:
         repec.update()
@@ -42,6 +106,10 @@ def update(args):
         remotes.update()
     if args.papers:
         papers.update()
+    if args.papers or settings.bulk_load:
+        database.create_indexes(settings.database)
+    if settings.bulk_load:
+        database.finish_bulk_load(settings.database, fts)
 
 
 if __name__ == '__main__':
@@ -61,6 +129,29 @@ if __name__ == '__main__':
         default=settings.database,
         help=f'SQLite database location (default: {settings.database})',
     )
+    p_init.add_argument(
+        '--codec',
+        choices=['zlib', 'zstd'],
+        default=settings.codec,
+        help=(
+            'Compression of the stored ReDIF records'
+            f' (default: {settings.codec})'
+        ),
+    )
+    p_init.add_argument(
+        '--level',
+        type=int,
+        default=settings.codec_level,
+        help='Compression level (default: depends on codec)',
+    )
+    p_init.add_argument(
+        '--fts',
+        action='store_true',
+        help=(
+            'Maintain a full-text index over titles, abstracts and author'
+            ' names'
+        ),
+    )
     p_init.add_argument(
         '--proxy',
         default=settings.proxy,
@@ -70,6 +161,199 @@ if __name__ == '__main__':
         ),
     )
 
+    # Migrate subcommand
+
+    p_migrate = commands.add_parser(
+        'migrate',
+        help='Migrate the database to the current version',
+        description='Migrate an existing database to the current version',
+    )
+    p_migrate.set_defaults(func=migrate)
+    p_migrate.add_argument(
+        '--database',
+        default=settings.database,
+        help=f'SQLite database location (default: {settings.database})',
+    )
+
+    # Benchmark subcommand
+
+    p_benchmark = commands.add_parser(
+        'benchmark',
+        help='Time typical analytical queries',
+        description=(
+            'Time typical analytical queries and show their query plans, to'
+            ' check that the secondary indexes are used'
+        ),
+    )
+    p_benchmark.set_defaults(func=benchmark)
+    p_benchmark.add_argument(
+        '--database',
+        default=settings.database,
+        help=f'SQLite database location (default: {settings.database})',
+    )
+    p_benchmark.add_argument(
+        '--repeat',
+        type=int,
+        default=3,
+        metavar='N',
+        help='Run each query N times, report the best time (default: 3)',
+    )
+
+    # Full-text index subcommand
+
+    p_fts = commands.add_parser(
+        'fts',
+        help='Create or rebuild the full-text index',
+        description=(
+            'Create or rebuild the full-text index over titles, abstracts'
+            ' and author names, which is kept up to date afterwards'
+        ),
+    )
+    p_fts.set_defaults(func=fts)
+    p_fts.add_argument(
+        '--database',
+        default=settings.database,
+        help=f'SQLite database location (default: {settings.database})',
+    )
+    p_fts.add_argument(
+        '--drop',
+        action='store_true',
+        help='Drop the full-text index instead',
+    )
+
+    # Recompress subcommand
+
+    p_recompress = commands.add_parser(
+        'recompress',
+        help='Encode stored ReDIF records again',
+        description=(
+            'Encode the ReDIF records stored in the database again with'
+            ' another codec or compression level, optionally with a newly'
+            ' trained zstd dictionary'
+        ),
+    )
+    p_recompress.set_defaults(func=recompress)
+    p_recompress.add_argument(
+        '--database',
+        default=settings.database,
+        help=f'SQLite database location (default: {settings.database})',
+    )
+    p_recompress.add_argument(
+        '--codec',
+        choices=['zlib', 'zstd'],
+        default='zstd',
+        help='Compression of the stored ReDIF records (default: zstd)',
+    )
+    p_recompress.add_argument(
+        '--level',
+        type=int,
+        help='Compression level (default: depends on codec)',
+    )
+    p_recompress.add_argument(
+        '--train',
+        action='store_true',
+        help=(
+            'Train a new zstd dictionary on a sample of the stored records'
+        ),
+    )
+    p_recompress.add_argument(
+        '--batchsize',
+        type=int,
+        default=settings.batch_size,
+        metavar='SIZE',
+        help=(
+            'Number of rows to commit in a single transaction'
+            f' (default: {settings.batch_size:,})'
+        ),
+    )
+    p_recompress.add_argument(
+        '--cpu-workers',
+        type=int,
+        default=os.cpu_count(),
+        metavar='N',
+        help=(
+            'Number of processes used for compression; if 0, records are'
+            f' compressed in the main process (default: {os.cpu_count()})'
+        ),
+    )
+    p_recompress.add_argument(
+        '-q', '--quiet',
+        action='count',
+        default=0,
+        help='Decrease verbosity level (can be given multiple times)',
+    )
+
+    # Reprocess subcommand
+
+    p_reprocess = commands.add_parser(
+        'reprocess',
+        help='Destructure stored papers again',
+        description=(
+            'Rebuild papers, authors and JEL codes from the ReDIF records'
+            ' stored in the database, without downloading them again'
+        ),
+    )
+    p_reprocess.set_defaults(func=reprocess)
+    p_reprocess.add_argument(
+        '--database',
+        default=settings.database,
+        help=f'SQLite database location (default: {settings.database})',
+    )
+    p_reprocess.add_argument(
+        '--handle',
+        metavar='PREFIX',
+        help='Only reprocess papers with handles starting with PREFIX',
+    )
+    p_reprocess.add_argument(
+        '--template',
+        help='Only reprocess papers of a given template type, e.g. paper',
+    )
+    p_reprocess.add_argument(
+        '--trust-language',
+        action='store_true',
+        help=(
+            'Use the language declared in a record as is, detect languages'
+            ' only for records that do not declare one'
+        ),
+    )
+    p_reprocess.add_argument(
+        '--language-cache',
+        type=int,
+        default=settings.language_cache,
+        metavar='N',
+        help=(
+            'Number of texts for which detected languages are remembered,'
+            f' per process (default: {settings.language_cache:,})'
+        ),
+    )
+    p_reprocess.add_argument(
+        '--batchsize',
+        type=int,
+        default=settings.batch_size,
+        metavar='SIZE',
+        help=(
+            'Number of rows to commit in a single transaction'
+            f' (default: {settings.batch_size:,})'
+        ),
+    )
+    p_reprocess.add_argument(
+        '--cpu-workers',
+        type=int,
+        default=os.cpu_count(),
+        metavar='N',
+        help=(
+            'Number of processes used for destructuring papers; if 0,'
+            ' papers are destructured in the main process'
+            f' (default: {os.cpu_count()})'
+        ),
+    )
+    p_reprocess.add_argument(
+        '-q', '--quiet',
+        action='count',
+        default=0,
+        help='Decrease verbosity level (can be given multiple times)',
+    )
+
     # Update subcommand
 
     p_update = commands.add_parser(
@@ -102,13 +386,72 @@ if __name__ == '__main__':
         action='store_true',
         help='Download papers',
     )
+    p_update.add_argument(
+        '--force',
+        action='store_true',
+        help='Download and process papers even if they have not changed',
+    )
+    p_update.add_argument(
+        '--bulk-load',
+        action='store_true',
+        help=(
+            'Load a new database faster, without a journal and with indexes'
+            ' built at the end; if interrupted, start over with a new'
+            ' database'
+        ),
+    )
+    p_update.add_argument(
+        '--cache',
+        default=settings.cache,
+        metavar='DIR',
+        help='Keep a copy of all downloaded files in a cache directory',
+    )
+    p_update.add_argument(
+        '--cache-limit',
+        type=float,
+        default=settings.cache_limit,
+        metavar='GIB',
+        help=(
+            'Maximum cache size, least recently used files are evicted'
+            f' (default: {settings.cache_limit} GiB)'
+        ),
+    )
+    p_update.add_argument(
+        '--offline',
+        action='store_true',
+        help=(
+            'Rebuild the database from the cache only, without accessing'
+            ' the network; implies --force'
+        ),
+    )
     p_update.add_argument(
         '--timeout',
         type=int,
         default=settings.timeout,
         help=(
-            'Timeout for individual requests, sec'
-            f' (default: {settings.timeout})'
+            'Longest time to wait for a response, sec; hosts that respond'
+            f' quickly get shorter timeouts (default: {settings.timeout})'
+        ),
+    )
+    p_update.add_argument(
+        '--connect-timeout',
+        type=int,
+        default=settings.connect_timeout,
+        metavar='SEC',
+        help=(
+            'Timeout for establishing a connection, sec'
+            f' (default: {settings.connect_timeout})'
+        ),
+    )
+    p_update.add_argument(
+        '--max-failures',
+        type=int,
+        default=settings.max_failures,
+        metavar='N',
+        help=(
+            'Skip a host after this many failures in a row, or never if 0;'
+            ' skipped downloads are retried in the next update'
+            f' (default: {settings.max_failures})'
         ),
     )
     p_update.add_argument(
@@ -117,10 +460,20 @@ if __name__ == '__main__':
         default=settings.batch_size,
         metavar='SIZE',
         help=(
-            'Number of papers to commit in a single transaction'
+            'Number of rows to commit in a single transaction'
             f' (default: {settings.batch_size:,})'
         ),
     )
+    p_update.add_argument(
+        '--commit-interval',
+        type=int,
+        default=settings.commit_interval,
+        metavar='SEC',
+        help=(
+            'Maximum time between commits, sec'
+            f' (default: {settings.commit_interval})'
+        ),
+    )
     p_update.add_argument(
         '--threads-repec',
         type=int,
@@ -141,6 +494,64 @@ if __name__ == '__main__':
             f' (default: {settings.no_threads_www})'
         ),
     )
+    p_update.add_argument(
+        '--threads-host',
+        type=int,
+        default=settings.no_threads_host,
+        metavar='N',
+        help=(
+            'Maximum number of concurrent downloads from a single host'
+            f' (default: {settings.no_threads_host})'
+        ),
+    )
+    p_update.add_argument(
+        '--engine',
+        choices=['threads', 'asyncio'],
+        default=settings.engine,
+        help=(
+            'Download engine for listings and papers; asyncio requires'
+            f' aiohttp (default: {settings.engine})'
+        ),
+    )
+    p_update.add_argument(
+        '--connections',
+        type=int,
+        default=settings.no_connections,
+        metavar='N',
+        help=(
+            'Number of concurrent HTTP requests with the asyncio engine'
+            f' (default: {settings.no_connections})'
+        ),
+    )
+    p_update.add_argument(
+        '--cpu-workers',
+        type=int,
+        default=settings.no_processes,
+        metavar='N',
+        help=(
+            'Number of processes used for destructuring papers; if 0,'
+            ' papers are destructured in the download threads'
+            f' (default: {settings.no_processes})'
+        ),
+    )
+    p_update.add_argument(
+        '--trust-language',
+        action='store_true',
+        help=(
+            'Use the language declared in a record as is, detect languages'
+            ' only for records that do not declare one'
+        ),
+    )
+    p_update.add_argument(
+        '--language-cache',
+        type=int,
+        default=settings.language_cache,
+        metavar='N',
+        help=(
+            'Number of texts for which detected languages are remembered,'
+            f' per process (default: {settings.language_cache:,})'
+        ),
+    )
     p_update.add_argument(
         '--proxy',
         default=settings.proxy,
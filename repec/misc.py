@@ -4,13 +4,19 @@
 """Miscellaneous routines."""
 
 # Load global packages
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from functools import wraps
+from collections import deque
+from pathlib import Path
 import sqlite3
+import threading
 
 # Load local packages
 import settings
 
+# Read-only database connections, one per thread
+READERS = threading.local()
+
 
 def iserror(err):
     """Check if err is an exception."""
@@ -41,6 +47,75 @@ def parallel(func, lst, threads):
         return list(meter(executor.map(func, lst), len(lst)))
 
 
+def stream(func, lst, threads, key=None, limit=None):
+    """Apply a function to a list in parallel, yield results as they come.
+
+    Unlike parallel(), no barrier is imposed: a new element is scheduled as
+    soon as any of the running ones completes, so a single slow element
+    does not keep the other threads idle. If a key function is given,
+    elements with different keys are interleaved, and at most limit
+    elements with the same key are processed at any time.
+    """
+    key = key or (lambda el: None)
+    limit = limit or threads
+    queues = {}
+    for el in lst:
+        queues.setdefault(key(el), deque()).append(el)
+    ready = deque(queues.keys())  # keys with queued elements and free slots
+    running = {k: 0 for k in queues.keys()}
+
+    def schedule(executor, pending):
+        while ready and len(pending) < threads:
+            k = ready.popleft()
+            f = executor.submit(func, queues[k].popleft())
+            pending[f] = k
+            running[k] += 1
+            if queues[k] and running[k] < limit:
+                ready.append(k)
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        pending = {}
+        schedule(executor, pending)
+        try:
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for f in done:
+                    k = pending.pop(f)
+                    running[k] -= 1
+                    if queues[k] and running[k] == limit - 1:
+                        ready.append(k)
+                schedule(executor, pending)
+                for f in done:
+                    yield f.result()
+        finally:
+            for f in pending:
+                f.cancel()
+
+
+def imap(func, it, executor=None, ahead=None):
+    """Apply a function to an iterable lazily, yield results in order.
+
+    Unlike executor.map(), which consumes the whole iterable at once, at
+    most ahead elements are submitted to the executor at any time. Without
+    an executor, the function is applied in the current thread.
+    """
+    if executor is None:
+        yield from map(func, it)
+        return
+    ahead = ahead or 2*executor._max_workers
+    pending = deque()
+    try:
+        for el in it:
+            pending.append(executor.submit(func, el))
+            if len(pending) >= ahead:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for f in pending:
+            f.cancel()
+
+
 def collect(lst):
     """Collect a list of key, value pairs into a dictionary."""
     dct = {}
@@ -50,6 +125,37 @@ def collect(lst):
     return dct
 
 
+def connect(database, **kwargs):
+    """Open a database connection tuned for bulk writing.
+
+    When bulk loading a new database, durability and foreign key checks
+    are traded for speed, see database.start_bulk_load().
+    """
+    conn = sqlite3.connect(database, **kwargs)
+    if settings.bulk_load:
+        conn.execute('PRAGMA journal_mode = OFF')
+        conn.execute('PRAGMA synchronous = OFF')
+        conn.execute(f'PRAGMA cache_size = {-settings.bulk_cache_size*1024}')
+        conn.execute(f'PRAGMA mmap_size = {settings.mmap_size*2**30}')
+        conn.execute('PRAGMA temp_store = MEMORY')
+        conn.execute('PRAGMA foreign_keys = OFF')
+    else:
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute('PRAGMA synchronous = NORMAL')
+        conn.execute(f'PRAGMA cache_size = {-settings.cache_size*1024}')
+        conn.execute('PRAGMA foreign_keys = ON')
+    return conn
+
+
+def reader(database):
+    """Get a read-only database connection for the current thread."""
+    conn = getattr(READERS, 'conn', None)
+    if conn is None:
+        uri = Path(database).absolute().as_uri() + '?mode=ro'
+        conn = READERS.conn = sqlite3.connect(uri, uri=True)
+    return conn
+
+
 def dbconnection(database):
     """Establish a database connection."""
     def decorator(func):
@@ -4,38 +4,302 @@
 
 # Load global packages
 import requests
+from requests.adapters import HTTPAdapter
 from requests.packages import urllib3
+from urllib.parse import urlparse, unquote
+from contextlib import contextmanager
+from io import BytesIO
+import ftplib
+import posixpath
+import re
+import socket
 import subprocess
+import threading
 
 # Load local packages
 import settings
+import cache
+import health
 
+# Pooled sessions, one per host
+SESSIONS = {}
+SESSIONS_LOCK = threading.Lock()
 
-def fetch(url):
+# Idle logged-in FTP connections, and hosts that only work with curl
+FTP_POOL = {}
+FTP_LOCK = threading.Lock()
+FTP_CURL = set()
+
+# Curl exit codes of failures to connect or to get a response in time
+CURL_NETWORK = {6, 7, 28, 35, 52, 55, 56}
+
+
+def host(url):
+    """Get the host part of an URL."""
+    return urlparse(url).hostname
+
+
+def session(url):
+    """Get a session that reuses connections to the host of an URL."""
+    key = urlparse(url)[:2]
+    with SESSIONS_LOCK:
+        s = SESSIONS.get(key)
+        if s is None:
+            s = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=settings.no_threads_host,
+            )
+            s.mount('http://', adapter)
+            s.mount('https://', adapter)
+            s.headers['User-Agent'] = settings.user_agent
+            if settings.proxy is not None:
+                s.proxies['http'] = settings.proxy
+                s.proxies['https'] = settings.proxy
+            SESSIONS[key] = s
+        return s
+
+
+class NotModified(Exception):
+    """The resource has not changed since it was last downloaded."""
+
+
+def fetch(url, headers={}):
     """Fetch an URL using requests."""
+    if settings.offline:
+        content, encoding, (etag, last_modified, _) = cache.load(url)
+        headers = {'ETag': etag, 'Last-Modified': last_modified}
+        return content, encoding, headers
     try:
-        headers = {'User-Agent': settings.user_agent}
-        proxies = {}
-        if settings.proxy is not None:
-            proxies['http'] = settings.proxy
-            proxies['https'] = settings.proxy
-        response = requests.get(url, timeout=settings.timeout, headers=headers, proxies=proxies)
+        with health.track(url) as timeouts:
+            response = session(url).get(
+                url, timeout=timeouts, headers=headers,
+            )
     except requests.exceptions.ConnectionError as err:
         if type(err.args[0]) == urllib3.exceptions.MaxRetryError:
             err.args = ('Max retries exceeded', )  # Simplify error message
             raise
         else:
             raise
+    if response.status_code == 304 and headers:
+        raise NotModified('Not modified')
     if response.status_code != 200:
         raise RuntimeError('HTTP Error {}'.format(response.status_code))
-    return response.content, response.encoding
+    cache.store(
+        url, response.content, response.encoding,
+        response.headers.get('ETag'), response.headers.get('Last-Modified'),
+    )
+    return response.content, response.encoding, response.headers
+
+
+def conditional(validators):
+    """Get headers for a conditional HTTP request."""
+    etag, last_modified, _ = validators or (None, None, None)
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+    return headers
+
+
+def fetch_new(url, validators=None):
+    """Fetch an URL unless it has not changed since it was last fetched.
+
+    Validators are (etag, last-modified, size) tuples: HTTP validators are
+    taken from the response headers, FTP validators from MDTM and SIZE.
+    Return content, encoding, and the validators to use next time. Raise
+    NotModified if the validators did not change.
+    """
+    if settings.offline:
+        return cache.load(url)
+    if validators is not None and not cache.fresh(url, validators):
+        validators = None  # download again, to fill the cache
+    scheme = urlparse(url)[0]
+    if scheme == 'ftp':
+        mdtm, size = stat_ftp(url)
+        _, old_mdtm, old_size = validators or (None, None, None)
+        if mdtm is not None and mdtm == old_mdtm and size in [None, old_size]:
+            raise NotModified('Not modified')
+        content = fetch_ftp(url)
+        cache.store(url, content, last_modified=mdtm)
+        return content, None, (None, mdtm, len(content))
+    elif scheme in ['http', 'https']:
+        content, encoding, headers = fetch(url, conditional(validators))
+        new = (headers.get('ETag'), headers.get('Last-Modified'), len(content))
+        return content, encoding, new
+    else:
+        raise RuntimeError('Unknown scheme {}'.format(scheme))
 
 
 def fetch_curl(url, options=[]):
     """Fetch an URL using curl."""
     proxy = ['--proxy', settings.proxy] if settings.proxy is not None else []
-    cmd = ['curl', *proxy, '-sm', str(settings.timeout), *options, url]
+    connect, read = health.timeouts(url)
+    timeouts = [
+        '--connect-timeout', str(connect),
+        '-Y', '1', '-y', str(round(read)),  # stalled transfers
+        '-m', str(settings.timeout),
+    ]
+    cmd = ['curl', *proxy, '-s', *timeouts, *options, url]
     rslt = subprocess.run(cmd, stdout=subprocess.PIPE)
+    if rslt.returncode in CURL_NETWORK:
+        raise ConnectionError('CURL Error {}'.format(rslt.returncode))
     if rslt.returncode != 0:
         raise RuntimeError('CURL Error {}'.format(rslt.returncode))
     return rslt.stdout
+
+
+def ftp_login(key):
+    """Open a new FTP connection and log in."""
+    hostname, port, user, passwd = key
+    ftp = ftplib.FTP(timeout=settings.connect_timeout)
+    try:
+        ftp.connect(hostname, port or 21)
+        ftp.sock.settimeout(settings.timeout)
+        ftp.login(user or 'anonymous', passwd or 'anonymous@')
+        ftp.home = ftp.pwd()
+        ftp.cwd_path = ftp.home
+    except BaseException:
+        ftp.close()
+        raise
+    return ftp
+
+
+def ftp_release(key, ftp):
+    """Return an FTP connection to the pool."""
+    with FTP_LOCK:
+        FTP_POOL.setdefault(key, []).append(ftp)
+
+
+@contextmanager
+def ftp_connection(key, reuse=True, timeout=None):
+    """Borrow a logged-in FTP connection, return it to the pool after use.
+
+    The read timeout, if given, applies while the connection is borrowed,
+    including to data connections.
+    """
+    ftp = None
+    if reuse:
+        with FTP_LOCK:
+            idle = FTP_POOL.get(key)
+            if idle:
+                ftp = idle.pop()
+    if ftp is None:
+        ftp = ftp_login(key)
+        ftp.reused = False
+    else:
+        ftp.reused = True
+    if timeout is not None:
+        ftp.timeout = timeout
+        ftp.sock.settimeout(timeout)
+    try:
+        yield ftp
+    except ftplib.error_perm:
+        ftp_release(key, ftp)  # e.g. a missing file, the connection is fine
+        raise
+    except BaseException:
+        ftp.close()
+        raise
+    ftp_release(key, ftp)
+
+
+def ftp_cwd(ftp, url):
+    """Change to the directory of an URL, return the file name."""
+    path = unquote(urlparse(url).path).lstrip('/')
+    directory, name = posixpath.split(path)
+    directory = posixpath.join(ftp.home, directory)
+    if ftp.cwd_path != directory:
+        ftp.cwd_path = None
+        ftp.cwd(directory)
+        ftp.cwd_path = directory
+    return name
+
+
+def ftp_retrieve(ftp, url, names_only):
+    """Download a file or a directory listing over an FTP connection."""
+    name = ftp_cwd(ftp, url)
+    buffer = BytesIO()
+    if name:
+        ftp.retrbinary('RETR ' + name, buffer.write)
+    else:
+        ftp.retrbinary('NLST' if names_only else 'LIST', buffer.write)
+    return buffer.getvalue()
+
+
+def ftp_stat(ftp, url):
+    """Get modification time and size of a file over an FTP connection."""
+    name = ftp_cwd(ftp, url)
+    try:
+        mdtm = ftp.sendcmd('MDTM ' + name)[4:].strip()
+    except ftplib.error_perm:
+        return None, None  # MDTM is not supported or the file is missing
+    try:
+        ftp.voidcmd('TYPE I')
+        size = ftp.size(name)
+    except ftplib.error_perm:
+        size = None
+    return mdtm, size
+
+
+def ftp_request(url, action, fallback):
+    """Run an action over a pooled FTP connection, fall back to curl."""
+    u = urlparse(url)
+    key = (u.hostname, u.port, u.username, u.password)
+    with health.track(url) as (_, read):
+        if settings.proxy is not None or key in FTP_CURL:
+            return fallback()
+        for reuse in [True, False]:
+            reused = False
+            try:
+                with ftp_connection(key, reuse, read) as ftp:
+                    reused = ftp.reused
+                    return action(ftp)
+            except ftplib.error_perm as err:
+                raise RuntimeError('FTP Error {}'.format(str(err)[:3]))
+            except socket.timeout:
+                raise  # a slow host, rather than a stale connection
+            except (OSError, EOFError):
+                if not reused:
+                    raise  # a network failure, curl would not help
+            except ftplib.Error:
+                if not reused:
+                    break
+            # Retry on a fresh connection in case this one is stale
+        # Some servers are broken in ways that only curl can handle
+        FTP_CURL.add(key)
+        return fallback()
+
+
+def fetch_ftp(url, names_only=False):
+    """Fetch an URL over a pooled FTP connection, fall back to curl.
+
+    URLs that end with a slash are treated as directories, and their
+    listings are returned (file names only if names_only is set).
+    """
+    options = ['-l'] if names_only else []
+    key = url + ' NLST' if names_only else url
+    if settings.offline:
+        return cache.load(key)[0]
+    content = ftp_request(
+        url,
+        lambda ftp: ftp_retrieve(ftp, url, names_only),
+        lambda: fetch_curl(url, options),
+    )
+    cache.store(key, content)
+    return content
+
+
+def stat_curl(url):
+    """Get modification time and size of an FTP file using curl."""
+    headers = fetch_curl(url, ['-I']).decode(errors='replace')
+    mdtm = re.search(r'^Last-Modified:\s*(.+?)\s*$', headers, flags=re.M)
+    size = re.search(r'^Content-Length:\s*([0-9]+)', headers, flags=re.M)
+    return mdtm and mdtm.group(1), size and int(size.group(1))
+
+
+def stat_ftp(url):
+    """Get modification time and size of an FTP file."""
+    return ftp_request(
+        url, lambda ftp: ftp_stat(ftp, url), lambda: stat_curl(url),
+    )
@@ -4,82 +4,113 @@
 """Routines for downloading and destructuring papers."""
 
 # Load global packages
-from urllib.parse import urlparse
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
 import re
 import sqlite3
 import json
-import zlib
-import threading
-import random
-import math
+from hashlib import sha1
 import cld2
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+import threading
 
 # Load local packages
 import settings
 import redif
-from misc import iserror, silent, parallel
+import codec
+import aionetwork
+import health
+from misc import iserror, silent, meter, stream, reader, imap
 from sanitize import sanitize, sanitize_email
-from network import fetch, fetch_curl
+from network import fetch_new, host, NotModified
+from writer import Writer
+
+# Define constants
+
+# Set up the writer connection for upsert_papers(). Papers whose records
+# are new or have changed are marked as touched, and the authors and JEL
+# codes of changed papers are deleted. New authors and JEL codes are then
+# only inserted for touched papers. (REPLACE would not do in the triggers,
+# as the conflict resolution of the outer upsert takes precedence.)
+WRITER_SQL = """
+    CREATE TEMP TABLE touched (
+        pid integer PRIMARY KEY,
+        digest text
+    );
+    CREATE TEMP TRIGGER papers_touched_insert AFTER INSERT ON main.papers
+    BEGIN
+        INSERT INTO touched VALUES (new.pid, new.digest)
+            ON CONFLICT (pid) DO UPDATE SET digest = excluded.digest;
+    END;
+    CREATE TEMP TRIGGER papers_touched_update AFTER UPDATE OF digest
+        ON main.papers WHEN old.digest IS NOT new.digest
+    BEGIN
+        DELETE FROM authors WHERE pid = new.pid;
+        DELETE FROM papers_jel WHERE pid = new.pid;
+        INSERT INTO touched VALUES (new.pid, new.digest)
+            ON CONFLICT (pid) DO UPDATE SET digest = excluded.digest;
+    END;
+"""
+
+PAPERS = [
+    'handle', 'url', 'template', 'language', 'title', 'abstract', 'journal',
+    'year', 'volume', 'issue', 'pages', 'redif', 'digest',
+]
+CHUNK_SIZE = 1000  # papers per task when destructuring
+TTYPE = re.compile(r'redif-(\S*)')
+TEMPLATE = re.compile('edif-([a-z]+)', flags=re.I)
+YEAR = re.compile('(?<![0-9])[0-9]{4}')
+JEL_SEP = re.compile('([A-Z])[-., ]+([0-9])')
+JEL_SPLIT = re.compile('[^A-Z0-9]+')
+JEL_CODE = re.compile('[A-Z][0-9]+$')
+
+# The record processor of the current process, see init_processor()
+PROCESSOR = None
 
 
 def ttype(record):
     """Get template type."""
     tt = next(v for k, v in record if k == 'template-type')
-    return re.match(r'redif-(\S*)', tt.lower()).group(1)
-
-
-@silent
-def load(url):
-    """Download ReDIF papers."""
-    scheme = urlparse(url)[0]
-    if scheme == 'ftp':
-        papers = redif.decode(fetch_curl(url))
-    elif scheme in ['http', 'https']:
-        content, encoding = fetch(url)
-        papers = redif.decode(content, hint=[encoding])
-    else:
-        raise RuntimeError('Unknown scheme {}'.format(scheme))
-    papers = redif.load(papers)
-    for p in papers:
+    return TTYPE.match(tt.lower()).group(1)
+
+
+def handle(record):
+    """Get record handle."""
+    return next(v for k, v in record if k == 'handle')
+
+
+def download(url, validators=None, response=None):
+    """Download a ReDIF document unless it has not changed.
+
+    Return content, encoding hints and new validators. An HTTP response
+    that has already been fetched, or the error that occurred while
+    fetching it, can be passed on instead of downloading.
+    """
+    if iserror(response):
+        raise response
+    content, encoding, validators = response or fetch_new(url, validators)
+    return content, [encoding] if encoding else [], validators
+
+
+def parse(content, encoding):
+    """Parse ReDIF papers, yield them one at a time."""
+    for p in redif.iterload(redif.decode_chunks(content, encoding)):
         fields = set(k for k, v in p)
         for f in ['handle', 'template-type']:
             if f not in fields:
                 raise RuntimeError('{} is missing'.format(f))
-    if len(papers) == 0:
-        raise RuntimeError('Empty series')
-    return papers
-
-
-def filterjel(jel, alljel):
-    """Verify a JEL code against the official list."""
-    if jel in alljel:
-        return jel
-    elif jel[:2] in alljel:
-        return jel[:2]
-
-def parsejel(jel, alljel):
-    """Parse JEL using ad-hoc rules."""
-    jel = re.sub('([A-Z])[-., ]+([0-9])', r'\1\2', jel)
-    jel = re.split('[^A-Z0-9]+', jel.upper())
-    jel = [c[:3] for c in jel if re.match('[A-Z][0-9]+$', c)]
-    jel = [filterjel(c, alljel) for c in jel]
-    jel = sorted(set(c for c in jel if c))
-    # Do not include JEL for papers that blindly follow the online example
-    if jel == ['R00', 'Z0']:
-        return []
-    return jel
+        yield p
 
 
 def parse_template(template):
     """Parse broken template specification."""
-    m = re.search('edif-([a-z]+)', template, flags=re.I)
+    m = TEMPLATE.search(template)
     return m.group(1).lower() if m else None
 
 
 def parse_year(date):
     """Parse broken date specification."""
-    m = re.search('(?<![0-9])[0-9]{4}', date)
+    m = YEAR.search(date)
     y = m.group(0) if m else None
     return int(y) if y and y != '0000' else None
 
@@ -104,9 +135,9 @@ def detect_language(text):
     return lang if lang != 'un' else None
 
 
-def lang_and(*text, default=None):
+def lang_and(*text, default=None, detect=detect_language):
     """Determine common language."""
-    lang = set(detect_language(t) for t in text if t)
+    lang = set(detect(t) for t in text if t)
     if len(lang) == 1:
         lang = lang.pop()
         if lang:
@@ -114,104 +145,601 @@ def lang_and(*text, default=None):
     return default
 
 
-def replace_paper(c, paper, url, alljel):
-    """Update a single paper record."""
-    blob = json.dumps(paper, ensure_ascii=False).encode(encoding='utf-8')
-    paper = redif.collect(paper)
-    r = {}
-    r['url'] = url
-    r['handle'] = paper['handle'][0]
-    r['template'] = parse_template(paper['template-type'][0])
-    for f in ['title', 'abstract', 'journal', 'volume', 'issue', 'pages']:
-        r[f] = paper.get(f, [None])[0]
-    for f in ['title', 'abstract', 'journal']:
-        r[f] = sanitize(r[f])
-    r['language'] = paper.get('language', ['none'])[0].lower()
-    r['language'] = r['language'] if len(r['language']) == 2 else None
-    r['language'] = lang_and(r['title'], r['abstract'], default=r['language'])
-    r['year'] = get_year(paper)
-    r['redif'] = zlib.compress(blob, level=9)
-
-    sql = 'REPLACE INTO papers (' + ', '.join(k for k in r.keys()) + ')'
-    sql += ' VALUES (' + ', '.join(['?']*len(r)) + ')'
-    c.execute(sql, list(r.values()))
-    pid = c.lastrowid
-
-    if 'author' in paper:
-        authors = [a for a in paper['author'] if type(a) == defaultdict]
-        authors = [
-            (sanitize(a['name'][0]), sanitize_email(a.get('email', [None])[0]))
-            for a in authors
-        ]
-        authors = [(pid, n, e) for n, e in authors if n]
-        sql = 'INSERT INTO authors (pid, name, email) VALUES (?, ?, ?)'
-        c.executemany(sql, authors)
-    if 'classification-jel' in paper:
-        jel = parsejel(paper['classification-jel'][0], alljel)
-        jel = [(pid, c) for c in jel]
-        c.executemany('INSERT INTO papers_jel (pid, code) VALUES (?, ?)', jel)
-
-
-def update_papers_1(conn, lock, url, alljel):
-    """Update papers from a single ReDIF document."""
-    papers = load(url)
-    with lock:
-        c = conn.cursor()
-        if iserror(papers):
-            sql = 'UPDATE listings SET status = 2, error = ? WHERE url = ?'
-            c.execute(sql, (str(papers), url))
+class LanguageDetector:
+    """Detect languages, remember the results for recently seen texts.
+
+    Titles in particular are often repeated across series and mirrors.
+    Results are kept by text digest, and the least recently used texts are
+    forgotten first. Cache hits and misses are counted.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def detect(self, text):
+        """Detect language of a text, see detect_language()."""
+        key = sha1(text.encode(encoding='utf-8')).digest()
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                self.hits += 1
+                return self.cache[key]
+        lang = detect_language(text)
+        with self.lock:
+            self.misses += 1
+            self.cache[key] = lang
+            if len(self.cache) > self.size:
+                self.cache.popitem(last=False)
+        return lang
+
+    def take(self):
+        """Return hits and misses counted so far, reset the counters."""
+        with self.lock:
+            counts = self.hits, self.misses
+            self.hits = self.misses = 0
+        return counts
+
+    def add(self, hits, misses):
+        """Add hits and misses counted elsewhere, e.g. in another process."""
+        with self.lock:
+            self.hits += hits
+            self.misses += misses
+
+    def report(self):
+        """Print cache statistics."""
+        total = self.hits + self.misses
+        if total > 0:
+            print(
+                f'Language detection: {self.hits} out of {total} texts'
+                f' found in cache ({self.hits/total:.0%})'
+            )
+
+
+def known_papers(database, handles):
+    """Get digests and URLs of the papers that are already in the database."""
+    c = reader(database).cursor()
+    known = {}
+    handles = list(handles)
+    for i in range(0, len(handles), 500):
+        chunk = handles[i:i+500]
+        sql = 'SELECT handle, digest, url FROM papers WHERE handle IN ('
+        sql += ', '.join(['?']*len(chunk)) + ')'
+        c.execute(sql, chunk)
+        known.update((h, (d, u)) for h, d, u in c.fetchall())
+    c.close()
+    return known
+
+
+class Processor:
+    """Destructure paper records into database rows.
+
+    A processor holds the official JEL codes as a set, a language detector,
+    and the codec for stored records. Each process sets up its own
+    processor with init_processor(), so that the codes and the codec
+    dictionaries do not have to be sent along with every task submitted to
+    a process pool. If trust_language is set, languages are only detected
+    for records that do not declare one.
+    """
+
+    def __init__(
+        self, alljel, coder=None, trust_language=False, cache_size=0,
+    ):
+        self.alljel = frozenset(alljel)
+        self.coder = coder or codec.Codec()
+        self.trust_language = trust_language
+        self.languages = LanguageDetector(cache_size)
+
+    def filterjel(self, jel):
+        """Verify a JEL code against the official list."""
+        if jel in self.alljel:
+            return jel
+        elif jel[:2] in self.alljel:
+            return jel[:2]
+
+    def parsejel(self, jel):
+        """Parse JEL using ad-hoc rules."""
+        jel = JEL_SEP.sub(r'\1\2', jel)
+        jel = JEL_SPLIT.split(jel.upper())
+        jel = [self.filterjel(c[:3]) for c in jel if JEL_CODE.match(c)]
+        jel = sorted(set(c for c in jel if c))
+        # Do not include JEL for papers that blindly follow the online example
+        if jel == ['R00', 'Z0']:
+            return []
+        return jel
+
+    def prepare_paper(self, paper, blob, url):
+        """Destructure a single paper record into database rows."""
+        paper = redif.collect(paper)
+        r = {}
+        r['url'] = url
+        r['handle'] = paper['handle'][0]
+        r['template'] = parse_template(paper['template-type'][0])
+        for f in ['title', 'abstract', 'journal', 'volume', 'issue', 'pages']:
+            r[f] = paper.get(f, [None])[0]
+        for f in ['title', 'abstract', 'journal']:
+            r[f] = sanitize(r[f])
+        r['language'] = paper.get('language', ['none'])[0].lower()
+        r['language'] = r['language'] if len(r['language']) == 2 else None
+        if not (self.trust_language and r['language']):
+            r['language'] = lang_and(
+                r['title'], r['abstract'], default=r['language'],
+                detect=self.languages.detect,
+            )
+        r['year'] = get_year(paper)
+        r['redif'] = self.coder.encode(blob)
+        r['digest'] = sha1(blob).hexdigest()
+
+        authors = []
+        if 'author' in paper:
+            authors = [a for a in paper['author'] if type(a) == defaultdict]
+            authors = [
+                (
+                    sanitize(a['name'][0]),
+                    sanitize_email(a.get('email', [None])[0]),
+                )
+                for a in authors
+            ]
+            authors = [
+                (n, e, r['handle'], url, r['digest']) for n, e in authors if n
+            ]
+        jel = []
+        if 'classification-jel' in paper:
+            jel = self.parsejel(paper['classification-jel'][0])
+            jel = [(c, r['handle'], url, r['digest']) for c in jel]
+        return tuple(r[k] for k in PAPERS), authors, jel
+
+    def prepare_papers(self, papers, url, database=None):
+        """Destructure paper records from a single ReDIF document.
+
+        If a database is given, the records that are already there,
+        unchanged and from the same URL, are skipped. Return the prepared
+        rows, and the digests of the skipped records by handle.
+        """
+        # A repeated handle replaces the earlier record together with its
+        # authors and JEL codes, so only the last occurrence needs to be kept
+        papers = {handle(p): p for p in papers}
+        known = known_papers(database, papers.keys()) if database else {}
+        rows, authors, jel = [], [], []
+        unchanged = {}
+        for h, paper in papers.items():
+            blob = json.dumps(paper, ensure_ascii=False)
+            blob = blob.encode(encoding='utf-8')
+            digest = sha1(blob).hexdigest()
+            if known.get(h) == (digest, url):
+                unchanged[h] = digest  # unchanged since the last update
+                continue
+            r, a, j = self.prepare_paper(paper, blob, url)
+            rows.append(r)
+            authors.extend(a)
+            jel.extend(j)
+        return (rows, authors, jel), unchanged
+
+    def reprocess_chunk(self, chunk):
+        """Destructure stored paper records again.
+
+        Return the prepared rows, as prepare_papers does, and the number
+        of records that could not be processed.
+        """
+        rows, authors, jel = [], [], []
+        failed = 0
+        for _, url, redif in chunk:
+            blob = self.coder.decode(redif)
+            r = silent(self.prepare_paper)(json.loads(blob), blob, url)
+            if iserror(r):
+                failed += 1
+                continue
+            rows.append(r[0])
+            authors.extend(r[1])
+            jel.extend(r[2])
+        return (rows, authors, jel), failed
+
+    def recompress_chunk(self, chunk):
+        """Encode stored paper records again with the current codec."""
+        rows = []
+        for handle, redif in chunk:
+            rows.append((self.coder.encode(self.coder.decode(redif)), handle))
+        return rows
+
+
+def init_processor(*args):
+    """Set up the record processor of the current process."""
+    global PROCESSOR
+    PROCESSOR = Processor(*args)
+
+
+# The following run with the processor of the current process. They also
+# return the language cache counters, so that the counters from worker
+# processes can be added up in the main process.
+
+def prepare_part(content, encoding, url, database=None):
+    """Parse and destructure a part of a ReDIF document.
+
+    Return the prepared rows, the digests of the skipped records, and the
+    number of records in the part.
+    """
+    papers = list(parse(content, encoding))
+    rows, unchanged = PROCESSOR.prepare_papers(papers, url, database)
+    return rows, unchanged, len(papers), PROCESSOR.languages.take()
+
+
+def reprocess_chunk(chunk):
+    """Destructure stored paper records again."""
+    rows = PROCESSOR.reprocess_chunk(chunk)
+    return rows, PROCESSOR.languages.take()
+
+
+def recompress_chunk(chunk):
+    """Encode stored paper records again."""
+    return PROCESSOR.recompress_chunk(chunk)
+
+
+def official_jel(conn):
+    """Get the official JEL codes from the database."""
+    c = conn.cursor()
+    c.execute('SELECT code FROM jel WHERE parent IS NOT NULL')
+    alljel = [r[0] for r in c.fetchall()]
+    c.close()
+    return alljel
+
+
+def process_pool(alljel, coder):
+    """Set up record processors, and a process pool if one is requested.
+
+    Workers are started on first use, from within download threads, so
+    they are not forked: a fork of a process with running threads can
+    inherit locks that are held by those threads, and hang.
+    """
+    args = (alljel, coder, settings.trust_language, settings.language_cache)
+    init_processor(*args)
+    if settings.no_processes > 0:
+        methods = multiprocessing.get_all_start_methods()
+        method = 'forkserver' if 'forkserver' in methods else 'spawn'
+        return ProcessPoolExecutor(
+            max_workers=settings.no_processes,
+            mp_context=multiprocessing.get_context(method),
+            initializer=init_processor,
+            initargs=args,
+        )
+    return None
+
+
+def upsert_papers(rows, rewrite=False):
+    """Return statements that write prepared paper records.
+
+    Papers are updated in place, so that their pids do not change. Their
+    authors and JEL codes are only rewritten if the records have changed,
+    or if rewrite is set. See WRITER_SQL.
+    """
+    papers, authors, jel = rows
+    sql = 'INSERT INTO papers (' + ', '.join(PAPERS) + ')'
+    sql += ' VALUES (' + ', '.join(['?']*len(PAPERS)) + ')'
+    sql += ' ON CONFLICT (handle) DO UPDATE SET '
+    sql += ', '.join(f'{c} = excluded.{c}' for c in PAPERS[1:])
+    sql += ', replaced_at = CURRENT_TIMESTAMP'
+    # Child rows are matched on the URL and the digest as well, so that if
+    # another record in the same batch has replaced a paper, only its own
+    # authors and JEL codes end up in the database
+    sql_authors = (
+        'INSERT INTO authors (pid, name, email)'
+        ' SELECT pid, ?, ? FROM papers JOIN touched USING (pid, digest)'
+        ' WHERE handle = ? AND url = ? AND digest = ?'
+    )
+    sql_jel = (
+        'INSERT INTO papers_jel (pid, code)'
+        ' SELECT pid, ? FROM papers JOIN touched USING (pid, digest)'
+        ' WHERE handle = ? AND url = ? AND digest = ?'
+    )
+    # Existing papers are only touched up front if rewrite is set. The
+    # statements are returned regardless, so that the writer always
+    # executes them in the same order.
+    where = 'WHERE pid IN (SELECT pid FROM papers WHERE handle = ?)'
+    sql_touch = 'REPLACE INTO touched SELECT pid, ? FROM papers'
+    sql_touch += ' WHERE handle = ?'
+    handles = [(r[0], ) for r in papers] if rewrite else []
+    touch = [(r[-1], r[0]) for r in papers] if rewrite else []
+    return [
+        (f'DELETE FROM authors {where}', handles),
+        (f'DELETE FROM papers_jel {where}', handles),
+        (sql_touch, touch),  # digest, handle
+        (sql, papers), (sql_authors, authors), (sql_jel, jel),
+        ('DELETE FROM touched', [()]),
+    ]
+
+
+def write_papers(
+    writer, url, content, hint, executor=None, database=None, rewrite=False,
+):
+    """Parse and destructure a ReDIF document, queue papers as they come.
+
+    The document is split into parts of about CHUNK_SIZE records, which are
+    decoded, parsed and destructured one at a time, in the process pool if
+    one is given, so that memory use does not grow with the size of the
+    document. If a database is given, papers that are stored already and
+    have not changed are skipped. If rewrite is set, the authors and JEL
+    codes of all papers are rewritten.
+    """
+    content, encoding, parts = redif.split(content, hint, CHUNK_SIZE)
+
+    def prepare(start, stop, database):
+        args = (content[start:stop], encoding, url, database)
+        if executor is None:
+            *rows, counts = prepare_part(*args)
         else:
-            sql = 'UPDATE listings SET status = 0, error = NULL WHERE url = ?'
-            c.execute(sql, (url, ))
-            for paper in papers:
-                replace_paper(c, paper, url, alljel)
-        c.close()
-    return not iserror(papers)
+            *rows, counts = executor.submit(prepare_part, *args).result()
+        PROCESSOR.languages.add(*counts)
+        return rows
+
+    seen = {}  # handle -> digests, for the papers queued so far
+    no_papers = 0
+    for start, stop in parts:
+        rows, unchanged, n = prepare(start, stop, database)
+        if any(d not in seen.get(h, [d]) for h, d in unchanged.items()):
+            # A repeated record is back to the stored version after another
+            # version was queued, so it has to be written again
+            rows, _, n = prepare(start, stop, None)
+        # Versions of records that are already queued from the same document
+        # are skipped, as their authors and JEL codes would be written twice
+        papers, authors, jel = rows
+        rows = (
+            [r for r in papers if r[-1] not in seen.get(r[0], ())],
+            [a for a in authors if a[-1] not in seen.get(a[2], ())],
+            [j for j in jel if j[-1] not in seen.get(j[1], ())],
+        )
+        for r in rows[0]:
+            seen.setdefault(r[0], set()).add(r[-1])  # handle, digest
+        no_papers += n
+        writer.put(*upsert_papers(rows, rewrite))
+    if no_papers == 0:
+        raise RuntimeError('Empty series')
+
+
+def update_papers_1(
+    writer, url, executor=None, validators=None, digest=None, response=None,
+):
+    """Update papers from a single ReDIF document.
+
+    Return True on success, False on failure, and None if the document
+    has not changed since the last update.
+    """
+    rows = silent(download)(url, validators, response)
+    if isinstance(rows, NotModified):
+        sql = 'UPDATE listings SET status = 0, error = NULL WHERE url = ?'
+        writer.put((sql, [(url, )]))
+        return None
+    if not iserror(rows):
+        content, hint, validators = rows
+        new = sha1(content).hexdigest()
+        if new == digest:
+            # Downloaded again, but the content is the same
+            sql = (
+                'UPDATE listings SET status = 0, error = NULL, etag = ?,'
+                ' last_modified = ?, size = ? WHERE url = ?'
+            )
+            writer.put((sql, [(*validators, url)]))
+            return None
+        digest = new
+        # A new database has nothing to compare against
+        skip = settings.force or settings.bulk_load
+        database = None if skip else settings.database
+        rows = silent(write_papers)(
+            writer, url, content, hint, executor, database, settings.force,
+        )
+    if isinstance(rows, health.HostDown):
+        # Leave the document pending, to be retried in the next update
+        sql = 'UPDATE listings SET error = ? WHERE url = ?'
+        writer.put((sql, [(str(rows), url)]))
+    elif iserror(rows):
+        sql = 'UPDATE listings SET status = 2, error = ? WHERE url = ?'
+        writer.put((sql, [(str(rows), url)]))
+    else:
+        sql = (
+            'UPDATE listings SET status = 0, error = NULL, etag = ?,'
+            ' last_modified = ?, size = ?, digest = ? WHERE url = ?'
+        )
+        writer.put((sql, [(*validators, digest, url)]))
+    return not iserror(rows)
 
 
-def update_papers(conn, lock, status=1):
+def update_papers(conn, writer, status=1):
     """Update papers from all ReDIF documents."""
+    alljel = official_jel(conn)
+    coder = codec.load(conn)
     c = conn.cursor()
-    c.execute('SELECT code FROM jel WHERE parent IS NOT NULL')
-    alljel = [r[0] for r in c.fetchall()]
-    c.execute('SELECT url FROM listings WHERE status = ?', (status, ))
-    urls = [r[0] for r in c.fetchall()]
-    urls = random.sample(urls, k=len(urls))  # to redistribute load
+    sql = (
+        'SELECT url, etag, last_modified, size, digest FROM listings'
+        ' WHERE status = ?'
+    )
+    c.execute(sql, (status, ))
+    known = {r[0]: (r[1:4], r[4]) for r in c.fetchall()}
+    if settings.force:
+        known = {u: (None, None) for u in known.keys()}
+    validators = {u: v for u, (v, _) in known.items()}
+    urls = list(known.keys())
     c.close()
 
-    def worker(u):
-        return update_papers_1(conn, lock, u, alljel)
+    # Downloads run in threads; if requested, CPU-bound destructuring is
+    # offloaded to a pool of processes. Each download thread waits for its
+    # own document, so no more than no_threads_www documents are in flight.
+    executor = process_pool(alljel, coder)
 
-    size = settings.batch_size
-    no_batches = math.ceil(len(urls)/size)
-    status = 0
-    for i in range(no_batches):
-        print('Downloading batch {}/{}...'.format(i+1, no_batches))
-        batch = urls[i*size:(i+1)*size]
-        bs = sum(parallel(worker, batch, threads=settings.no_threads_www))
-        status += bs
-        conn.commit()
-        print(f'{bs} out of {len(batch)} records updated successfully')
+    def worker(u, response=None):
+        return update_papers_1(writer, u, executor, *known[u], response)
 
+    # Progress is committed by the writer in the background, and listings
+    # are marked as done no earlier than the last of their papers
+    print('Downloading papers...')
+    try:
+        if settings.engine == 'asyncio':
+            status = aionetwork.stream(
+                worker, urls, key=host, validators=validators,
+            )
+        else:
+            status = stream(
+                worker, urls, threads=settings.no_threads_www,
+                key=host, limit=settings.no_threads_host,
+            )
+        status = list(meter(status, len(urls)))
+    finally:
+        if executor is not None:
+            executor.shutdown()
     print(
-        f'All batches: {status} out of {len(urls)} records'
-        ' updated successfully'
+        f'{status.count(True)} out of {len(urls)} records updated'
+        f' successfully, {status.count(None)} unchanged'
     )
+    PROCESSOR.languages.report()
+    health.report()
+
+
+def selection(prefix=None, template=None):
+    """Build an SQL condition to select papers by handle and template."""
+    where, args = [], []
+    if prefix:
+        escaped = re.sub(r'([\\%_])', r'\\\1', prefix)
+        where.append("handle LIKE ? ESCAPE '\\'")
+        args.append(escaped + '%')
+    if template:
+        where.append('template = ?')
+        args.append(template)
+    return ' AND '.join(['1', *where]), args
+
+
+def stored_papers(conn, prefix=None, template=None, columns='url, redif'):
+    """Read stored paper records in chunks, ordered by handle.
+
+    Rows contain the handle followed by the requested columns.
+    """
+    where, args = selection(prefix, template)
+    # Paginate on handle rather than keeping a cursor open, so that no read
+    # transaction spans the whole run
+    sql = f'SELECT handle, {columns} FROM papers WHERE {where}'
+    sql += ' AND handle > ? ORDER BY handle LIMIT ?'
+    last = ''
+    while True:
+        rows = conn.execute(sql, (*args, last, CHUNK_SIZE)).fetchall()
+        if not rows:
+            break
+        last = rows[-1][0]
+        yield rows
+
+
+def reprocess_papers(conn, writer, prefix=None, template=None):
+    """Destructure stored ReDIF records again, without downloading.
+
+    Papers can be selected by handle prefix and by template type.
+    """
+    alljel = official_jel(conn)
+    coder = codec.load(conn)
+    c = conn.cursor()
+    where, args = selection(prefix, template)
+    c.execute(f'SELECT count(*) FROM papers WHERE {where}', args)
+    no_papers = c.fetchone()[0]
+    c.close()
+
+    executor = process_pool(alljel, coder)
+
+    print('Reprocessing papers...')
+    failed = 0
+    try:
+        chunks = stored_papers(conn, prefix, template)
+        status = imap(reprocess_chunk, chunks, executor)
+        no_chunks = (no_papers + CHUNK_SIZE - 1)//CHUNK_SIZE
+        for (rows, f), counts in meter(status, no_chunks):
+            writer.put(*upsert_papers(rows, rewrite=True))
+            PROCESSOR.languages.add(*counts)
+            failed += f
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    print(
+        f'{no_papers - failed} out of {no_papers} records reprocessed'
+        ' successfully'
+    )
+    PROCESSOR.languages.report()
+
+
+def reprocess(prefix=None, template=None):
+    """Destructure stored ReDIF records again (wrapper)."""
+    conn = sqlite3.connect(settings.database)
+    try:
+        with Writer(settings.database, script=WRITER_SQL) as writer:
+            reprocess_papers(conn, writer, prefix, template)
+    finally:
+        conn.close()
+
+
+def recompress_papers(conn, writer, name, level=None, train=False):
+    """Encode all stored ReDIF records again with a new codec.
+
+    If train is set, a new zstd dictionary is trained on a random sample of
+    the stored records. Otherwise, the current dictionary, if any, is kept.
+    """
+    old = codec.load(conn)
+    dictionaries = old.dictionaries
+    dict_id = old.dict_id
+    if train:
+        print('Training dictionary...')
+        sql = (
+            'SELECT redif FROM papers WHERE pid IN'
+            ' (SELECT pid FROM papers ORDER BY random() LIMIT ?)'
+        )
+        rows = conn.execute(sql, (codec.NO_SAMPLES, )).fetchall()
+        samples = [old.decode(r[0]) for r in rows]
+        dict_id, data = codec.train(samples)
+        dictionaries = {**dictionaries, dict_id: data}
+    new = codec.Codec(name, level, dictionaries, dict_id)
+
+    # Records written with the old dictionaries must remain readable until
+    # they have all been encoded again
+    with conn:
+        codec.save(conn, new)
+    no_papers, = conn.execute('SELECT count(*) FROM papers').fetchone()
+
+    executor = process_pool(official_jel(conn), new)
+
+    print('Recompressing papers...')
+    sql = 'UPDATE papers SET redif = ? WHERE handle = ?'
+    try:
+        chunks = stored_papers(conn, columns='redif')
+        status = imap(recompress_chunk, chunks, executor)
+        no_chunks = (no_papers + CHUNK_SIZE - 1)//CHUNK_SIZE
+        for rows in meter(status, no_chunks):
+            writer.put((sql, rows))
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return new
+
+
+def recompress(name, level=None, train=False):
+    """Encode all stored ReDIF records again (wrapper)."""
+    conn = sqlite3.connect(settings.database)
+    try:
+        with Writer(settings.database) as writer:
+            new = recompress_papers(conn, writer, name, level, train)
+        # Only now that all the records have been written, drop unused
+        # dictionaries
+        dictionaries = {}
+        if new.dict_id is not None:
+            dictionaries[new.dict_id] = new.dictionaries[new.dict_id]
+        new = codec.Codec(new.name, new.level, dictionaries, new.dict_id)
+        with conn:
+            codec.save(conn, new)
+        size, = conn.execute(
+            'SELECT sum(length(redif)) FROM papers'
+        ).fetchone()
+        print(f'Stored records take {(size or 0)/2**20:,.1f} MiB')
+    finally:
+        conn.close()
 
 
 def update():
     """Update papers from all ReDIF documents (wrapper)."""
-    conn = sqlite3.connect(settings.database, check_same_thread=False)
-    c = conn.cursor()
-    c.execute('PRAGMA foreign_keys = ON')
-    c.close()
-
-    lock = threading.Lock()
+    conn = sqlite3.connect(settings.database)
     try:
-        update_papers(conn, lock)
-    except BaseException:
-        conn.rollback()
-        raise
-    else:
-        conn.commit()
-    conn.close()
+        with Writer(settings.database, script=WRITER_SQL) as writer:
+            update_papers(conn, writer)
+    finally:
+        conn.close()
@@ -8,9 +8,10 @@ This patch is not yet integrated into the main code.
 
 # Load local packages
 import settings
+import database
 from misc import dbconnection, collect
 import redif
-from repec import ftp_get
+from network import fetch_ftp
 
 
 @dbconnection(settings.database)
@@ -42,7 +43,8 @@ def collect_names(files):
     for i, file in enumerate(files):
         print(f'[{i+1}/{len(files)}] {file}...')
         try:
-            rdf = redif.load(redif.decode(ftp_get(settings.repec_ftp + file)))
+            content = fetch_ftp(settings.repec_ftp + file)
+            rdf = redif.load(redif.decode(content))
             for record in rdf:
                 record = collect(record)
                 if 'name' in record:
@@ -65,16 +67,6 @@ def merge(handles, names):
     return {h: names[h.lower()] for h in handles if h.lower() in names}
 
 
-@dbconnection(settings.database)
-def ensure_indices(conn):
-    """Create necessary indices if missing."""
-    sql = """
-        CREATE INDEX IF NOT EXISTS papers_tejoha
-        ON papers (template, journal, handle);
-    """
-    conn.execute(sql)
-
-
 @dbconnection(settings.database)
 def update_names(conn, names):
     """Update journal names from series names."""
@@ -89,7 +81,7 @@ def update_names(conn, names):
 
 def main():
     """Run the whole update."""
-    ensure_indices()
+    database.create_indexes(settings.database)
     handles = fetch_handles()
     files = fetch_files(handles=handles)
     names = collect_names(files)
@@ -5,6 +5,8 @@
 
 # Load global packages
 import re
+import sys
+import codecs
 from collections import defaultdict
 
 # Define constants
@@ -15,61 +17,152 @@ CLUSTERS = set([
     'provider-name',
     'workplace-name',
 ])
-
-
-def decode(rdf, hint=[]):
-    """Decode ReDIF document."""
-    def decode(encoding):
-        rslt = rdf.decode(encoding)
-        if rslt.lower().find('template-type') == -1:
-            raise RuntimeError('Decoding Error')
-        return rslt
-
+LONE_CR = re.compile('\r(?!\n)')
+COMMENT = re.compile('\n#[^\n]*')
+FIELD = re.compile(r'\n([a-zA-Z0-9\-#]+):')
+TEMPLATE = re.compile(r'\ntemplate-type:[^\S\n]*\S', flags=re.I)
+CHUNK_SIZE = 2**16  # bytes, when decoding incrementally
+
+# Encodings that extend ASCII, and bytes that are undefined in windows-1252
+ASCII = set(['ascii', 'cp1252', 'iso8859-1', 'utf-8', 'utf-8-sig'])
+UNDEFINED_1252 = [bytes([b]) for b in [0x81, 0x8d, 0x8f, 0x90, 0x9d]]
+MARKER = re.compile(b'template-type', flags=re.I)
+TEMPLATE_BYTES = re.compile(rb'template-type:[^\S\r\n]*\S')  # lowercase
+BOM_16 = [codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE]
+
+
+def decode_chunks(rdf, encoding):
+    """Decode a byte string incrementally, yield text chunks."""
+    if codecs.lookup(encoding).name == 'utf-16' and rdf[:2] not in BOM_16:
+        # Unlike bytes.decode(), the incremental decoder requires a BOM
+        encoding = 'utf-16-le' if sys.byteorder == 'little' else 'utf-16-be'
+    decoder = codecs.getincrementaldecoder(encoding)()
+    view = memoryview(rdf)
+    for i in range(0, len(view), CHUNK_SIZE):
+        yield decoder.decode(view[i:i+CHUNK_SIZE])
+    yield decoder.decode(b'', final=True)
+
+
+def check(rdf, encoding):
+    """Check that a ReDIF document decodes and mentions template-type.
+
+    For encodings that extend ASCII, the template-type field is looked up
+    in the raw bytes, and validity is checked from byte statistics where
+    possible, so that the document is not decoded in full.
+    """
+    encoding = codecs.lookup(encoding).name
+    if encoding in ASCII:
+        if not MARKER.search(rdf):
+            return False
+        if rdf.isascii() or encoding == 'iso8859-1':
+            return True
+        if encoding == 'ascii':
+            return False
+        if encoding == 'cp1252':
+            return not any(b in rdf for b in UNDEFINED_1252)
+        for _ in decode_chunks(rdf, encoding):
+            pass  # raises if the document is not valid UTF-8
+        return True
+    found, tail = False, ''
+    for chunk in decode_chunks(rdf, encoding):
+        if not found:
+            text = tail + chunk.lower()
+            found = text.find('template-type') != -1
+            tail = text[-12:]
+    return found
+
+
+def detect(rdf, hint=[]):
+    """Find the encoding of a ReDIF document."""
     encodings = hint + ['windows-1252', 'utf-8', 'utf-16', 'latin-1']
     if rdf[:3] == b'\xef\xbb\xbf':
         encodings = ['utf-8-sig'] + encodings
     for enc in encodings:
         try:
-            return decode(enc)
+            if check(rdf, enc):
+                return enc
         except Exception:
             continue
     raise RuntimeError('Decoding Error')
 
 
-def split(lst, sel):
-    """Split a list using a selector function."""
-    group = []
-    groups = [group]
-    for el in lst:
-        if sel(el):
-            group = []
-            groups.append(group)
-        group.append(el)
-    return groups
+def decode(rdf, hint=[]):
+    """Decode ReDIF document."""
+    return rdf.decode(detect(rdf, hint))
+
+
+def split(rdf, hint=[], size=1):
+    """Split ReDIF document into parts of about size templates each.
+
+    Return the document, its encoding, and the byte ranges of the parts.
+    Parts start at template-type fields, so that each part can be decoded
+    and parsed on its own. Documents in encodings that do not extend ASCII
+    are converted to UTF-8 first.
+    """
+    encoding = detect(rdf, hint)
+    if codecs.lookup(encoding).name not in ASCII:
+        rdf = ''.join(decode_chunks(rdf, encoding)).encode('utf-8')
+        encoding = 'utf-8'
+    # A literal is found much faster in lowercase bytes than with re.I
+    low = rdf.lower()
+    starts = [
+        max(m.start() - 1, 0) for m in TEMPLATE_BYTES.finditer(low)
+        if m.start() == 0 or low[m.start() - 1] in b'\r\n'
+    ]
+    bounds = [0, *starts[size::size], len(rdf)]
+    return rdf, encoding, list(zip(bounds[:-1], bounds[1:]))
 
 
 def load(rdf):
     """Load ReDIF document."""
     # Repair line endings
-    rdf = re.sub('\r(?!\n)', '\r\n', rdf, flags=re.M)
+    if rdf.count('\r') != rdf.count('\r\n'):
+        rdf = LONE_CR.sub('\r\n', rdf)
 
-    # Drop comments
-    rdf = re.sub('^#.*\n?', '', rdf, flags=re.M)
-
-    # Split fields
-    rdf = re.split(r'(^[a-zA-Z0-9\-#]+:\s*)', rdf, flags=re.M)[1:]
-    rdf = [line.strip() for line in rdf]
-    rdf = [
-        (rdf[i].rstrip(':').lower(), rdf[i+1])
-        for i in range(0, len(rdf), 2)
-    ]
+    # Drop comments; with a leading line break, every line starts after one
+    rdf = '\n' + rdf
+    if '\n#' in rdf:
+        rdf = COMMENT.sub('', rdf)
 
-    # Drop empty fields
-    rdf = [f for f in rdf if f[1] != '']
+    # Split fields, drop empty ones
+    rdf = FIELD.split(rdf)
+    keys = '\n'.join(rdf[1::2]).lower().split('\n')
+    values = map(str.strip, rdf[2::2])
+    rdf = [(k, v) for k, v in zip(keys, values) if v != '']
 
     # Split templates
-    rdf = split(rdf, lambda x: x[0] == 'template-type')[1:]
-    return rdf
+    starts = [i for i, (k, _) in enumerate(rdf) if k == 'template-type']
+    ends = starts[1:] + [len(rdf)]
+    return [rdf[i:j] for i, j in zip(starts, ends)]
+
+
+def iterload(chunks):
+    """Load ReDIF document from text chunks, yield templates one at a time.
+
+    Text is accumulated up to the last template-type field seen so far,
+    and everything before it is parsed, so that only about one chunk, or
+    one template if that is longer, is held in memory at a time. Fields
+    with the value on the next line are never taken as a template start,
+    which only delays parsing.
+    """
+    buffer, tail, start = '', '', 0
+    for chunk in chunks:
+        # A trailing CR might be followed by LF in the next chunk
+        chunk = tail + chunk
+        tail = '\r' if chunk.endswith('\r') else ''
+        chunk = chunk[:len(chunk) - len(tail)]
+        if chunk.count('\r') != chunk.count('\r\n'):
+            chunk = LONE_CR.sub('\r\n', chunk)
+        buffer += chunk
+        last = None
+        for m in TEMPLATE.finditer(buffer, start):
+            last = m.start()
+        if last:
+            yield from load(buffer[:last])
+            buffer = buffer[last:]
+        # An incomplete match can only start at the last line break
+        start = max(buffer.rfind('\n'), 0)
+    yield from load(buffer + tail)
 
 
 def collect(records):
@@ -7,27 +7,28 @@
 import re
 from urllib.parse import urlparse, urljoin
 from lxml import etree
-import random
-import threading
 import sqlite3
 
 # Load local packages
 import settings
-from misc import iserror, silent, parallel
-from network import fetch, fetch_curl
+import aionetwork
+import health
+from misc import iserror, silent, meter, stream
+from network import fetch, fetch_ftp, host
+from writer import Writer
 
 
 def listing_ftp(url):
     """Download an FTP directory listing."""
-    files = fetch_curl(url, ['-l']).decode().splitlines()
+    files = fetch_ftp(url, names_only=True).decode().splitlines()
     prog = re.compile(r'.+\.(rdf|redif)$', flags=re.I)
     files = [f for f in files if prog.match(f)]
     return [url + f for f in files]
 
 
-def listing_http(url):
+def listing_http(url, response=None):
     """Download an HTTP directory listing."""
-    content, _ = fetch(url)
+    content = (response or fetch(url))[0]
     html = etree.HTML(content)
     files = html.xpath('//a/@href')
     prog = re.compile(r'.+\.(rdf|redif)$', flags=re.I)
@@ -36,13 +37,15 @@ def listing_http(url):
 
 
 @silent
-def listing(url):
+def listing(url, response=None):
     """Get a list of ReDIF files for a given series."""
+    if iserror(response):
+        raise response
     scheme = urlparse(url)[0]
     if scheme == 'ftp':
         files = listing_ftp(url)
     elif scheme in ['http', 'https']:
-        files = listing_http(url)
+        files = listing_http(url, response)
     else:
         raise RuntimeError('Unknown scheme {}'.format(scheme))
     if len(files) == 0:
@@ -50,49 +53,57 @@ def listing(url):
     return files
 
 
-def update_listings_1(conn, lock, url):
+def update_listings_1(writer, url, response=None):
     """Update remote listings for a single series."""
-    files = listing(url)
-    with lock:
-        c = conn.cursor()
-        if iserror(files):
-            sql = 'UPDATE remotes SET status = 2, error = ? WHERE url = ?'
-            c.execute(sql, (str(files), url))
-        else:
-            files = [(f, url) for f in files]
-            sql = 'UPDATE remotes SET status = 0, error = NULL WHERE url = ?'
-            c.execute(sql, (url, ))
-            sql = 'REPLACE INTO listings (url, remote) VALUES (?, ?)'
-            c.executemany(sql, files)
-        c.close()
+    files = listing(url, response)
+    if isinstance(files, health.HostDown):
+        # Leave the listing pending, to be retried in the next update
+        sql = 'UPDATE remotes SET error = ? WHERE url = ?'
+        writer.put((sql, [(str(files), url)]))
+    elif iserror(files):
+        sql = 'UPDATE remotes SET status = 2, error = ? WHERE url = ?'
+        writer.put((sql, [(str(files), url)]))
+    else:
+        files = [(f, url) for f in files]
+        sql = 'UPDATE remotes SET status = 0, error = NULL WHERE url = ?'
+        # Keep validators of known listings, they are checked for changes
+        sql_listings = (
+            'INSERT INTO listings (url, remote) VALUES (?, ?)'
+            ' ON CONFLICT (url) DO UPDATE SET remote = excluded.remote,'
+            ' status = 1, error = NULL, replaced_at = CURRENT_TIMESTAMP'
+        )
+        writer.put((sql, [(url, )]), (sql_listings, files))
     return not iserror(files)
 
 
-def update_listings(conn, lock, status=1):
+def update_listings(conn, writer, status=1):
     """Update remote listings for all series."""
     c = conn.cursor()
     c.execute('SELECT url FROM remotes WHERE status = ?', (status, ))
     urls = [r[0] for r in c.fetchall()]
-    urls = random.sample(urls, k=len(urls))  # to redistribute load
     c.close()
     print('Updating remote listings...')
 
-    def worker(u):
-        return update_listings_1(conn, lock, u)
+    def worker(u, response=None):
+        return update_listings_1(writer, u, response)
 
-    status = parallel(worker, urls, settings.no_threads_www)
-    print(f'{sum(status)} out of {len(urls)} records updated successfully')
+    if settings.engine == 'asyncio':
+        status = aionetwork.stream(worker, urls, key=host)
+    else:
+        status = stream(
+            worker, urls, threads=settings.no_threads_www,
+            key=host, limit=settings.no_threads_host,
+        )
+    status = sum(meter(status, len(urls)))
+    print(f'{status} out of {len(urls)} records updated successfully')
+    health.report()
 
 
 def update():
     """Update remote listings (wrapper)."""
-    conn = sqlite3.connect(settings.database, check_same_thread=False)
-    lock = threading.Lock()
+    conn = sqlite3.connect(settings.database)
     try:
-        update_listings(conn, lock)
-    except BaseException:
-        conn.rollback()
-        raise
-    else:
-        conn.commit()
-    conn.close()
+        with Writer(settings.database) as writer:
+            update_listings(conn, writer)
+    finally:
+        conn.close()
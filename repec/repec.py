@@ -5,17 +5,18 @@
 
 # Load global packages
 import re
-import threading
-import sqlite3
 from datetime import datetime
+from hashlib import sha1
 
 # Load local packages
 import settings
 import redif
-from misc import iserror, silent, parallel, collect
-from network import fetch_curl
+import health
+from misc import iserror, silent, parallel, connect
+from network import fetch_ftp
+from writer import Writer
 
-# RePEc FTP is broken; using curl as a workaround
+# RePEc FTP is broken; fetch_ftp falls back to curl as a workaround
 
 
 def ftp_datetime(month, day, tory):
@@ -25,12 +26,15 @@ def ftp_datetime(month, day, tory):
     else:
         time, year = '00:00', tory
     dt = ' '.join((year, month, day, time))
-    return datetime.strptime(dt, '%Y %b %d %H:%M')
+    dt = datetime.strptime(dt, '%Y %b %d %H:%M')
+    if tory.find(':') != -1 and dt > datetime.now():
+        dt = dt.replace(year=dt.year - 1)  # dates within the past 6 months
+    return dt
 
 
 def ftp_ls(url):
     """Get file listing (with modification dates)."""
-    files = fetch_curl(url).decode().splitlines()
+    files = fetch_ftp(url).decode().splitlines()
     prog = re.compile(
         r'\S+\s+\S+\s+\S+\s+\S+\s+\S+\s+(\S+)\s+(\S+)\s+(\S+)\s+(.+)'
     )
@@ -46,15 +50,30 @@ def update_repec(conn):
     files = [(*m.groups(), d) for m, d in files if m]
     files = [(n, t.lower(), d.isoformat(sep=' ')) for n, t, e, d in files]
     c = conn.cursor()
-    sql = 'REPLACE INTO repec (file, type, ftpdate) VALUES (?, ?, ?)'
+    # Only new, modified, or previously failed files need to be loaded
+    sql = (
+        'INSERT INTO repec (file, type, ftpdate) VALUES (?, ?, ?)'
+        ' ON CONFLICT (file) DO UPDATE SET type = excluded.type,'
+        ' ftpdate = excluded.ftpdate, status = CASE'
+        ' WHEN ftpdate IS excluded.ftpdate AND status = 0 THEN 0 ELSE 1 END,'
+        ' replaced_at = CURRENT_TIMESTAMP'
+    )
     c.executemany(sql, files)
+    if settings.force:
+        c.execute('UPDATE repec SET status = 1')
+    c.execute('SELECT count(*) FROM repec WHERE status = 1')
+    no_files = c.fetchone()[0]
     c.close()
+    print(
+        f'Skipping {max(len(files) - no_files, 0)} out of {len(files)} files'
+        ' that have not changed since the last update'
+    )
 
 
 @silent
-def load(file, cat):
+def load(content, file, cat):
     """Load a series or an archive file."""
-    rdf = redif.load(redif.decode(fetch_curl(settings.repec_ftp + file)))
+    rdf = redif.load(redif.decode(content))
 
     def key(r):
         r = dict(r)
@@ -63,87 +82,128 @@ def load(file, cat):
     return [key(r) for r in rdf]
 
 
-def update_series_1(conn, lock, file, cat):
-    """Update the database for a series or an archive file."""
-    r = load(file, cat)
-    with lock:
-        c = conn.cursor()
-        if iserror(r):
-            sql = 'UPDATE repec SET status = 2, error = ? WHERE file = ?'
-            c.execute(sql, (str(r), file))
-        else:
+def update_series_1(writer, file, cat, digest=None):
+    """Update the database for a series or an archive file.
+
+    Return True on success, False on failure, and None if the file has
+    not changed since the last update.
+    """
+    r = content = silent(fetch_ftp)(settings.repec_ftp + file)
+    if not iserror(content):
+        new = sha1(content).hexdigest()
+        if new == digest:
             sql = 'UPDATE repec SET status = 0, error = NULL WHERE file = ?'
-            c.execute(sql, (file, ))
-            sql = (
-                'REPLACE INTO series (file, type, handle, url)'
-                ' VALUES (?, ?, ?, ?)'
-            )
-            c.executemany(sql, r)
-        c.close()
+            writer.put((sql, [(file, )]))
+            return None
+        r = load(content, file, cat)
+    if isinstance(r, health.HostDown):
+        # Leave the file pending, to be retried in the next update
+        sql = 'UPDATE repec SET error = ? WHERE file = ?'
+        writer.put((sql, [(str(r), file)]))
+    elif iserror(r):
+        sql = 'UPDATE repec SET status = 2, error = ? WHERE file = ?'
+        writer.put((sql, [(str(r), file)]))
+    else:
+        sql = (
+            'UPDATE repec SET status = 0, error = NULL, digest = ?'
+            ' WHERE file = ?'
+        )
+        sql_series = (
+            'REPLACE INTO series (file, type, handle, url)'
+            ' VALUES (?, ?, ?, ?)'
+        )
+        writer.put((sql, [(new, file)]), (sql_series, r))
     return not iserror(r)
 
 
-def update_series(conn, lock, status=1):
+def update_series(conn, writer, status=1):
     """Update all archive and series files in the database."""
     c = conn.cursor()
-    c.execute('SELECT file, type FROM repec WHERE status = ?', (status, ))
+    sql = 'SELECT file, type, digest FROM repec WHERE status = ?'
+    c.execute(sql, (status, ))
     files = c.fetchall()
     c.close()
     print('Updating archive and series files...')
 
     def worker(el):
-        return update_series_1(conn, lock, *el)
+        file, cat, digest = el
+        digest = None if settings.force else digest
+        return update_series_1(writer, file, cat, digest)
     status = parallel(worker, files, threads=settings.no_threads_repec)
-    print(f'{sum(status)} out of {len(files)} records updated successfully')
+    print(
+        f'{status.count(True)} out of {len(files)} records updated'
+        f' successfully, {status.count(None)} unchanged'
+    )
+    health.report()
 
 
-def update_remotes(conn, status=1):
-    """Update the list of remotes in the database."""
+def update_remotes(conn):
+    """Update the list of remotes in the database.
+
+    All series are resolved, not only the reloaded ones, since their
+    archives might have changed, and all remotes are marked for a visit.
+    """
     c = conn.cursor()
 
-    # Archives
-    sql = 'SELECT handle, url FROM series, repec USING (file)'
-    sql += ' WHERE series.type = "arch" ORDER BY ftpdate DESC'
-    c.execute(sql)
-    archives = [(h.lower(), u) for h, u in c.fetchall()]
-    archives = {k: v[0] for k, v in collect(archives).items()}
-    c.execute('UPDATE series SET status = 0 WHERE type = "arch"')
-
-    # Series
-    def lookup(s):
-        a, sep, f = s[1].rpartition(':')
-        a = archives.get(a.lower())
-        if a:
-            return (a + f + '/', 0, None, *s)
-        else:
-            return (None, 2, 'Archive not found', *s)
-
-    sql = 'SELECT file, handle FROM series WHERE type = "seri" AND status = ?'
-    c.execute(sql, (status, ))
-    series = [lookup(s) for s in c.fetchall()]
+    # Archives, if an archive is listed in several files, the most recent
+    # file wins
+    c.execute(
+        'CREATE TEMP TABLE archives (handle text PRIMARY KEY, url text)'
+    )
     sql = (
-        'UPDATE series SET url = ?, status = ?, error = ?'
-        ' WHERE file = ? AND handle = ?'
+        'INSERT OR IGNORE INTO archives'
+        ' SELECT lower(handle), url FROM series JOIN repec USING (file)'
+        " WHERE series.type = 'arch' ORDER BY ftpdate DESC"
     )
-    c.executemany(sql, series)
+    c.execute(sql)
+    c.execute("UPDATE series SET status = 0 WHERE type = 'arch'")
+
+    # Series, a series handle is the archive handle followed by a colon and
+    # the series code, which is appended to the archive URL. The last colon
+    # is found by trimming all other characters off the end. Series that
+    # resolve as before are not rewritten.
+    sql = """
+        UPDATE series SET url = r.url, status = r.status, error = r.error
+        FROM (
+            SELECT s.rowid AS id,
+                a.url || substr(s.handle, s.colon + 1) || '/' AS url,
+                iif(a.url IS NULL, 2, 0) AS status,
+                iif(a.url IS NULL, 'Archive not found', NULL) AS error
+            FROM (
+                SELECT rowid, handle,
+                    length(rtrim(handle, replace(handle, ':', ''))) AS colon
+                FROM series WHERE type = 'seri'
+            ) AS s
+            LEFT JOIN archives AS a
+                ON a.handle = lower(substr(s.handle, 1, s.colon - 1))
+        ) AS r
+        WHERE series.rowid = r.id
+            AND (series.url, series.status, series.error)
+                IS NOT (r.url, r.status, r.error)
+    """
+    c.execute(sql)
+    c.execute('DROP TABLE temp.archives')
 
     # Remotes
-    remotes = list(set((s[0],) for s in series if s[0]))
-    c.executemany('REPLACE INTO remotes (url) VALUES (?)', remotes)
+    sql = (
+        'INSERT INTO remotes (url)'
+        " SELECT DISTINCT url FROM series WHERE type = 'seri' AND status = 0"
+        ' ON CONFLICT (url) DO UPDATE SET status = 1, error = NULL,'
+        ' replaced_at = CURRENT_TIMESTAMP'
+    )
+    c.execute(sql)
     c.close()
 
 
 def update():
     """Update the database on the basis of RePEc information."""
-    conn = sqlite3.connect(settings.database, check_same_thread=False)
-    lock = threading.Lock()
+    conn = connect(settings.database)
     try:
-        update_repec(conn)
-        update_series(conn, lock)
-        update_remotes(conn)
-    except BaseException:
-        conn.rollback()
-        raise
-    else:
-        conn.commit()
-    conn.close()
+        with conn:
+            update_repec(conn)
+        with Writer(settings.database) as writer:
+            update_series(conn, writer)
+        with conn:
+            update_remotes(conn)
+    finally:
+        conn.close()
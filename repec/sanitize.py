@@ -5,6 +5,7 @@
 
 # Load packages
 import re
+from html import unescape
 from lxml.html import tostring, html5parser
 import warnings
 
@@ -20,18 +21,35 @@ def prepare_cc():
     # Non latin-1 and non utf-8 opening characters
     undefined = list(range(0x80, 0x9f + 1))
 
-    return re.compile('|'.join([
-        *(chr(c) for c in cc),  # control characters
-        *(chr(c) for c in undefined),  # undefined characters
-        *('&#x0*' + hex(c)[2:] + ';' for c in cc),  # html-escaped control characters (hex)
-        *('&#0*' + str(c) + ';' for c in cc),  # html-escaped control characters (decimal)
-    ]))
+    # A character class and a common prefix keep the regex fast
+    chars = ''.join(re.escape(chr(c)) for c in cc + undefined)
+    hexadecimal = '|'.join(hex(c)[2:] for c in cc)
+    decimal = '|'.join(str(c) for c in cc)
+    return re.compile(
+        f'[{chars}]'  # control characters and undefined characters
+        f'|&#(?:x0*(?:{hexadecimal})|0*(?:{decimal}));'  # html-escaped
+    )
 
 
 # Define global settings
 BLOCKTAGS = ['div', 'p', 'br', 'li', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6']
 EMAIL = re.compile("['a-z0-9._-]+@[a-z0-9._-]+.[a-z]+")
 CC = prepare_cc()
+HTML = re.compile(
+    '|'.join([f'<{t}>' for t in BLOCKTAGS] + ['</', '/>', '&#?x?[0-9a-z]+;'])
+)
+ENTITY = re.compile(r'&#x?[0-9a-f\s]+;', flags=re.I)
+SPACE = re.compile(r'\s')
+NA = re.compile(r'\W*[nN]\W*[aA]\W*')
+INVALID = re.compile(r'[\W0-9]*')
+
+# Tags that simple_html2text() renders without building an html tree:
+# paragraphs, line breaks, and inline formatting that is properly nested
+INLINETAGS = ['i', 'b', 'em', 'strong', 'sub', 'sup', 'u']
+SIMPLETAG = re.compile(
+    r'<(/?)(p|br|' + '|'.join(INLINETAGS) + r')[ \t\n\r\f]*(/?)>',
+    flags=re.I | re.A,
+)
 
 
 def remove_cc(text):
@@ -41,28 +59,79 @@ def remove_cc(text):
 
 def sanitize_entity(text):
     """Remove whitespace characters from HTML entities."""
+    if '&#' not in text:
+        return text
+
     def strip(m):
-        return re.sub(r'\s', '', m.group(0))
-    return re.sub(r'&#x?[0-9a-f\s]+;', strip, text, flags=re.I)
+        return SPACE.sub('', m.group(0))
+    return ENTITY.sub(strip, text)
+
+
+def collapse(text):
+    """Convert runs of whitespace to single spaces, strip."""
+    return ' '.join(text.split())
 
 
 def ishtml(text):
     """Guess whether text has html in it."""
-    text = text.lower()
-    for t in BLOCKTAGS:
-        if text.find(f'<{t}>') != -1:
-            return True
-    if text.find('</') != -1 or text.find('/>') != -1:
-        return True
-    if re.search('&#?x?[0-9a-z]+;', text):
-        return True
-    return False
+    return HTML.search(text.lower()) is not None
+
+
+def simple_html2text(html):
+    """Render html with simple markup only, return None for other html.
+
+    The result is the same as that of html2text() before whitespace is
+    collapsed: block tags add a space after their content, and before it
+    if the content starts with text. Html that the html5 parser would
+    restructure, e.g. misnested tags, is left to html2text().
+    """
+    text, stack, opened, pos = [], [], False, 0
+    for m in [*SIMPLETAG.finditer(html), None]:
+        chunk = html[pos:m.start() if m else len(html)]
+        if '<' in chunk:
+            return None  # other tags, or text that the parser might take so
+        if chunk:
+            text.append(' ' + unescape(chunk) if opened else unescape(chunk))
+        if m is None:
+            break
+        pos, opened = m.end(), False
+        close, tag, void = m.group(1), m.group(2).lower(), m.group(3)
+        if tag == 'br':
+            if close:
+                return None
+            text.append(' ')
+        elif void:
+            return None
+        elif tag == 'p':
+            if 'p' in stack:
+                if stack[-1] != 'p':
+                    return None  # closing the paragraph closes inline tags
+                stack.pop()
+                text.append(' ')
+            elif close:
+                text.append(' ')  # a stray </p> is an empty paragraph
+            if not close:
+                stack.append('p')
+                opened = True
+        elif close:
+            if not stack or stack[-1] != tag:
+                return None
+            stack.pop()
+        else:
+            stack.append(tag)
+    return ''.join(text)
 
 
 def html2text(html):
     """Render html as text, convert line breaks to spaces."""
     if not ishtml(html):
-        return re.sub(r'\s+', ' ', html.strip())
+        return collapse(html)
+    if '<' not in html:
+        text = unescape(html)  # only entities
+    else:
+        text = simple_html2text(html)
+    if text is not None:
+        return collapse(text)
     parser = html5parser.HTMLParser(namespaceHTMLElements=False)
     with warnings.catch_warnings():
         warnings.simplefilter('ignore')
@@ -76,12 +145,12 @@ def html2text(html):
             else:
                 e.text = e.text + ' '
     text = tostring(html, method='text', encoding='utf-8')
-    return re.sub(r'\s+', ' ', text.decode().strip())
+    return collapse(text.decode())
 
 
 def isna(token):
     """Check if it's an N/A token."""
-    if re.sub(r'\W', '', token).lower() == 'na':
+    if NA.fullmatch(token):
         return True
     else:
         return False
@@ -89,7 +158,7 @@ def isna(token):
 
 def isvalid(token):
     """Check if token contains alpha characters."""
-    if re.match(r'^[\W0-9]*$', token):
+    if INVALID.fullmatch(token):
         return False
     else:
         return True
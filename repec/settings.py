@@ -8,13 +8,37 @@ import os
 
 # Default command line arguments
 database = './repec.db'
-timeout = 300  # seconds
-batch_size = 10000  # records in each commit
+timeout = 300  # seconds, the longest read timeout
+connect_timeout = 30  # seconds
+min_timeout = 30  # seconds, the shortest adaptive read timeout
+max_failures = 10  # failures in a row before a host is skipped
+cooldown = 600  # seconds before a skipped host is probed again
+batch_size = 10000  # rows in each commit
+commit_interval = 60  # seconds between commits
 no_threads_repec = 32
 no_threads_www = 128
+no_threads_host = 4  # concurrent requests to a single host
+no_processes = 0  # destructure papers in download threads
+engine = 'threads'  # or 'asyncio'
+force = False  # reprocess documents even if unchanged
+bulk_load = False  # load a new database without journal and FK checks
+cache = None  # directory for caching downloads
+cache_limit = 100  # GiB
+offline = False  # read downloads from cache only
+codec = 'zlib'  # or 'zstd', for stored ReDIF records
+codec_level = None  # codec default
+fts = False  # maintain a full-text index
+trust_language = False  # detect languages only if not declared
+language_cache = 100000  # texts with remembered languages, per process
+no_connections = 1024  # concurrent requests with the asyncio engine
 proxy=None
 verbosity = 3
 
+# Database tuning
+cache_size = 256  # MiB, per connection
+bulk_cache_size = 4096  # MiB, per connection, when bulk loading
+mmap_size = 64  # GiB, when bulk loading
+
 # Additional configuration
 repec_ftp = 'ftp://all.repec.org/RePEc/all/'
 jel = 'https://www.aeaweb.org/econlit/classificationTree.xml'
@@ -0,0 +1,177 @@
+# Copyright (c) 2019-2020, CPB Netherlands Bureau for Economic Policy Analysis
+# Copyright (c) 2019-2020, Andrey Dubovik <andrei@dubovik.eu>
+
+"""Compatibility checks of the ReDIF parser.
+
+The parsed templates are compared against the output of the original
+parser, load(decode(rdf)), as it was before parsing was made incremental.
+Run with pytest from this directory.
+"""
+
+# Load global packages
+import random
+import pytest
+
+# Load local packages
+import redif
+
+# Sample documents, in various encodings and with various line endings
+LF = """\
+# Archive listing, maintained by hand
+Template-Type: ReDIF-Paper 1.0
+Title: Oligopolistic Markets   and Entry
+Author-Name: Jane Doe
+Author-Email: jane@example.org
+Author-Workplace-Name: Some University
+Author-Name: Zo\xeb \xdcnal
+Abstract: A model of entry
+ spread over
+   several lines.
+Classification-JEL: D43, L13
+Number:
+Handle: RePEc:abc:wpaper:1
+
+template-type: ReDIF-Paper 1.0
+title:
+  Value on the next line
+abstract: Mentions template-type: in passing,
+template-type: at a line start is a new template though
+#Comment without a space
+Handle: RePEc:abc:wpaper:2
+"""
+
+CRLF = """\
+Template-Type: ReDIF-Article 1.0
+Title: Caf\xe9 prices in M\xfcnchen – a note
+Author-Name: Fran\xe7ois L\xe9vesque
+# a comment in between
+Journal: Revue \xe9conomique
+Year: 2010
+Abstract: First line
+ second line
+Handle: RePEc:abc:journl:v:1:y:2010:i:1:p:1-10
+Template-Type: ReDIF-Article 1.0
+Title: Second article
+Handle: RePEc:abc:journl:v:1:y:2010:i:1:p:11-20
+""".replace('\n', '\r\n')
+
+CR = """\
+Template-Type: ReDIF-Series 1.0
+Name: Working Papers
+Provider-Name: Institute
+Provider-Homepage: http://example.org
+Handle: RePEc:abc:wpaper
+Template-Type: ReDIF-Series 1.0
+Name: Journal
+Description: Spread
+ over two lines
+Handle: RePEc:abc:journl
+""".replace('\n', '\r')
+
+UTF16 = """\
+Template-Type: ReDIF-Paper 1.0
+Title: Экономика и рынки
+Author-Name: Иван Петров
+Abstract: Строка один
+ строка два
+Handle: RePEc:abc:wpaper:3
+Template-Type: ReDIF-Paper 1.0
+Title: Second paper
+Handle: RePEc:abc:wpaper:4
+""".replace('\n', '\r\n')
+
+SAMPLES = {
+    'lf': LF.encode('utf-8-sig'),
+    'crlf': CRLF.encode('windows-1252'),
+    'cr': CR.encode('ascii'),
+    'utf16': UTF16.encode('utf-16'),
+}
+
+# Output of the original parser on the samples above
+EXPECTED = {
+    'lf': [[('template-type', 'ReDIF-Paper 1.0'),
+            ('title', 'Oligopolistic Markets   and Entry'),
+            ('author-name', 'Jane Doe'),
+            ('author-email', 'jane@example.org'),
+            ('author-workplace-name', 'Some University'),
+            ('author-name', 'Zoë Ünal'),
+            ('abstract', 'A model of entry\n spread over\n   several lines.'),
+            ('classification-jel', 'D43, L13'),
+            ('handle', 'RePEc:abc:wpaper:1')],
+           [('template-type', 'ReDIF-Paper 1.0'),
+            ('title', 'Value on the next line'),
+            ('abstract', 'Mentions template-type: in passing,')],
+           [('template-type', 'at a line start is a new template though'),
+            ('handle', 'RePEc:abc:wpaper:2')]],
+    'crlf': [[('template-type', 'ReDIF-Article 1.0'),
+              ('title', 'Café prices in München – a note'),
+              ('author-name', 'François Lévesque'),
+              ('journal', 'Revue économique'),
+              ('year', '2010'),
+              ('abstract', 'First line\r\n second line'),
+              ('handle', 'RePEc:abc:journl:v:1:y:2010:i:1:p:1-10')],
+             [('template-type', 'ReDIF-Article 1.0'),
+              ('title', 'Second article'),
+              ('handle', 'RePEc:abc:journl:v:1:y:2010:i:1:p:11-20')]],
+    'cr': [[('template-type', 'ReDIF-Series 1.0'),
+            ('name', 'Working Papers'),
+            ('provider-name', 'Institute'),
+            ('provider-homepage', 'http://example.org'),
+            ('handle', 'RePEc:abc:wpaper')],
+           [('template-type', 'ReDIF-Series 1.0'),
+            ('name', 'Journal'),
+            ('description', 'Spread\r\n over two lines'),
+            ('handle', 'RePEc:abc:journl')]],
+    'utf16': [[('template-type', 'ReDIF-Paper 1.0'),
+               ('title', 'Экономика и рынки'),
+               ('author-name', 'Иван Петров'),
+               ('abstract', 'Строка один\r\n строка два'),
+               ('handle', 'RePEc:abc:wpaper:3')],
+              [('template-type', 'ReDIF-Paper 1.0'),
+               ('title', 'Second paper'),
+               ('handle', 'RePEc:abc:wpaper:4')]],
+}
+
+
+def parse_parts(rdf, size):
+    """Split a document into parts, parse each part on its own."""
+    rdf, encoding, parts = redif.split(rdf, size=size)
+    return [
+        template for start, stop in parts
+        for template in redif.iterload(
+            redif.decode_chunks(rdf[start:stop], encoding)
+        )
+    ]
+
+
+@pytest.mark.parametrize('name', SAMPLES)
+def test_load(name):
+    assert redif.load(redif.decode(SAMPLES[name])) == EXPECTED[name]
+
+
+@pytest.mark.parametrize('name', SAMPLES)
+@pytest.mark.parametrize('size', [1, 2, 3, 5, 64, None])
+def test_iterload(name, size):
+    rdf = redif.decode(SAMPLES[name])
+    size = size or len(rdf)
+    chunks = [rdf[i:i+size] for i in range(0, len(rdf), size)]
+    assert list(redif.iterload(chunks)) == EXPECTED[name]
+
+
+@pytest.mark.parametrize('name', SAMPLES)
+def test_iterload_random(name):
+    rdf = redif.decode(SAMPLES[name])
+    rng = random.Random(name)
+    for _ in range(100):
+        bounds = sorted(rng.sample(range(1, len(rdf)), rng.randint(1, 20)))
+        bounds = [0, *bounds, len(rdf)]
+        chunks = [rdf[i:j] for i, j in zip(bounds[:-1], bounds[1:])]
+        assert list(redif.iterload(chunks)) == EXPECTED[name]
+
+
+@pytest.mark.parametrize('name', SAMPLES)
+@pytest.mark.parametrize('size', [1, 2, 3])
+def test_split(name, size, monkeypatch):
+    # Small chunks split multibyte characters between decoder calls
+    monkeypatch.setattr(redif, 'CHUNK_SIZE', 3)
+    assert parse_parts(SAMPLES[name], size) == EXPECTED[name]
@@ -0,0 +1,119 @@
+# Copyright (c) 2021, Andrey Dubovik <andrei@dubovik.eu>
+
+"""A dedicated thread for writing to the database."""
+
+# Load global packages
+import queue
+import threading
+import time
+
+# Load local packages
+import settings
+from misc import connect
+
+
+class Writer:
+    """Own a database connection, write queued rows in large batches.
+
+    Producers call put() with one or more (sql, rows) pairs that belong
+    together, e.g. a listing status and the papers from that listing. The
+    writer collects rows across many such calls, runs a single executemany
+    per distinct SQL statement, and commits. Statements are executed in the
+    order in which they were first seen, so producers must always queue
+    dependent statements after the statements they depend on. A script,
+    if given, is run once the connection is open, e.g. to set up temporary
+    tables and triggers.
+    """
+
+    def __init__(self, database, batch_size=None, interval=None, script=None):
+        self.database = database
+        self.script = script
+        self.batch_size = batch_size or settings.batch_size
+        self.interval = interval or settings.commit_interval
+        self.queue = queue.Queue(maxsize=settings.no_threads_www)
+        self.error = None
+        self.aborted = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def check(self):
+        """Re-raise an error from the writer thread, or fail if it stopped."""
+        if self.error is not None:
+            raise RuntimeError('Database writer failed') from self.error
+        if not self.thread.is_alive():
+            raise RuntimeError('Database writer has stopped')
+
+    def enqueue(self, item):
+        """Put an item on the queue unless the writer has failed."""
+        while True:
+            self.check()
+            try:
+                self.queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def put(self, *statements):
+        """Queue (sql, rows) pairs to be written in the same transaction."""
+        self.enqueue(statements)
+
+    def run(self):
+        """Drain the queue, commit by row count or by elapsed time."""
+        conn = None
+        pending, no_rows, started = {}, 0, time.monotonic()
+        try:
+            conn = connect(self.database)
+            if self.script is not None:
+                conn.executescript(self.script)
+            while True:
+                timeout = self.interval - time.monotonic() + started
+                timeout = min(max(timeout, 0), 1)
+                try:
+                    statements = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    statements = ()
+                if self.aborted.is_set():
+                    return
+                if statements is None:
+                    break
+                for sql, rows in statements:
+                    pending.setdefault(sql, []).extend(rows)
+                    no_rows += len(rows)
+                elapsed = time.monotonic() - started
+                if no_rows >= self.batch_size or elapsed >= self.interval:
+                    self.flush(conn, pending)
+                    pending, no_rows = {}, 0
+                    started = time.monotonic()
+            self.flush(conn, pending)
+        except BaseException as err:
+            self.error = err
+        finally:
+            if conn is not None:
+                conn.close()
+
+    def flush(self, conn, pending):
+        """Write pending rows in a single transaction."""
+        with conn:
+            for sql, rows in pending.items():
+                conn.executemany(sql, rows)
+
+    def close(self):
+        """Write remaining rows and stop the writer."""
+        self.enqueue(None)
+        self.thread.join()
+        if self.error is not None:
+            raise RuntimeError('Database writer failed') from self.error
+
+    def abort(self):
+        """Stop the writer, discard uncommitted rows."""
+        self.aborted.set()
+        self.thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()